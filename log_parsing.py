@@ -0,0 +1,212 @@
+"""
+Extraction of timeseries (timestep, dt, CFL, residuals, ...) from `run.log`.
+
+A task lists the lines of its solver's output it is interested in as
+`LogPattern`s in `log_patterns`, each a regular expression whose named groups
+become the columns of a timeseries:
+
+    class Task(BaseTask):
+        log_patterns = [
+            LogPattern('timestep', r'n=(?P<n>\d+) t=(?P<t>\S+) dt=(?P<dt>\S+) CFL=(?P<cfl>\S+)'),
+            LogPattern('residual', r'residual: (?P<residual>\S+)'),
+        ]
+
+`updateLogTimeseries` parses the part of the log written since it was last
+called and appends the values found to `log_<name>.npy` in the run
+directory, so it is cheap to call repeatedly while a run is in progress
+(`RunSupervisor` and `TaskRun` do so). The arrays are structured with one
+field per column and can be memory-mapped::
+
+    timestep = loadLogTimeseries('/data/runs/task_20140301_120000', 'timestep')
+    plot.semilogy(timestep['t'], timestep['cfl'])
+"""
+
+import os
+import re
+import errno
+import fcntl
+import struct
+
+import numpy as np
+import numpy.lib.format
+
+import yaml
+
+LOG_TIMESERIES_STATE_FILENAME = 'log_timeseries.yml'
+LOG_TIMESERIES_FILENAME_FORMAT = 'log_%s.npy'
+
+# length of the log tail kept to check that the log hasn't been rewritten
+# (e.g. by `stripBackspaces`) since it was last parsed
+_check_length = 64
+
+class LogPattern(object):
+    """
+    Lines matching `regex` are added to the timeseries `name`, with a column
+    for each named group of the regex (converted to `dtype`). The log is
+    searched a block of lines at a time, so the regex shouldn't match across
+    the end of a line.
+    """
+    def __init__(self, name, regex, dtype=float):
+        self.name = name
+        # matched against many lines at once, so ^ and $ match at line ends
+        self.regex = re.compile(regex, re.MULTILINE)
+        if len(self.regex.groupindex) == 0:
+            raise ValueError("The regex for %s doesn't have any named groups" % name)
+        if self.regex.groups != len(self.regex.groupindex):
+            raise ValueError("All groups in the regex for %s must be named, use (?:...) for others" % name)
+        self.columns = [column for (column, _) in sorted(self.regex.groupindex.items(), key=lambda item: item[1])]
+        self.dtype = np.dtype([(column, dtype) for column in self.columns])
+
+    def findAll(self, text):
+        """
+        Values of the columns of every match in `text`.
+        """
+        types = [self.dtype[column].type for column in self.columns]
+        rows = []
+        for match in self.regex.finditer(text):
+            try:
+                rows.append(tuple([t(value) for (t, value) in zip(types, match.groups())]))
+            except (ValueError, TypeError):
+                # e.g. "nan" printed in an unexpected way
+                pass
+        return rows
+
+    def __repr__(self):
+        return "<LogPattern %s: %s>" % (self.name, self.regex.pattern)
+
+def _writeHeader(fh, dtype, length, header_length=None):
+    header = "{'descr': %s, 'fortran_order': False, 'shape': (%d,), }" % (repr(numpy.lib.format.dtype_to_descr(dtype)), length)
+    if header_length is None:
+        # leave room for the length to grow, aligned like numpy does
+        header_length = ((len(header) + 10 + 1 + 32)//64 + 1)*64 - 10
+    if len(header) + 1 > header_length:
+        raise ValueError("Header of %s doesn't fit" % fh.name)
+    fh.seek(0)
+    fh.write(numpy.lib.format.MAGIC_PREFIX + "\x01\x00" + struct.pack("<H", header_length))
+    fh.write(header.ljust(header_length - 1) + "\n")
+
+def _appendRows(filename, dtype, rows):
+    """
+    Append `rows` to the one-dimensional .npy file `filename`, creating it if
+    need be. The data is written before the header is updated, so that
+    readers never see rows which aren't there yet, and rows left behind after
+    the last complete append (by a process which died before updating the
+    header) are overwritten.
+    """
+    data = np.array(rows, dtype=dtype)
+    if not os.path.exists(filename):
+        fh = open(filename, "w+b")
+        _writeHeader(fh, dtype, 0)
+    else:
+        fh = open(filename, "r+b")
+    fh.seek(0)
+    numpy.lib.format.read_magic(fh)
+    (length,), _, _ = numpy.lib.format.read_array_header_1_0(fh)
+    header_length = fh.tell() - 10
+
+    fh.seek(header_length + 10 + length*np.dtype(dtype).itemsize)
+    fh.truncate()
+    fh.write(data.tostring())
+    fh.flush()
+    _writeHeader(fh, dtype, length + len(data), header_length=header_length)
+    fh.close()
+
+def _readState(output_directory):
+    try:
+        fh = open(os.path.join(output_directory, LOG_TIMESERIES_STATE_FILENAME))
+    except IOError:
+        return None
+    state = yaml.safe_load(fh)
+    fh.close()
+    return state
+
+def _writeState(output_directory, state):
+    fh = open(os.path.join(output_directory, LOG_TIMESERIES_STATE_FILENAME), "w")
+    yaml.safe_dump(state, fh, default_flow_style=False)
+    fh.close()
+
+def _logUnchanged(logfile, state):
+    """
+    Check that the part of the log parsed already hasn't changed since.
+    """
+    offset = state['offset']
+    logfile.seek(max(offset - _check_length, 0))
+    return logfile.read(min(offset, _check_length)) == state['tail']
+
+def _removeTimeseries(output_directory, patterns):
+    for pattern in patterns:
+        try:
+            os.remove(os.path.join(output_directory, LOG_TIMESERIES_FILENAME_FORMAT % pattern.name))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+def updateLogTimeseries(output_directory, patterns, chunk_size=4194304):
+    """
+    Parse the part of `run.log` in `output_directory` added since the last
+    update with `patterns` (a list of `LogPattern`s), appending the values
+    found to the timeseries files. If the log (or the patterns) changed in
+    any other way the timeseries are extracted again from scratch. Returns
+    the number of lines matched.
+    """
+    try:
+        logfile = open(os.path.join(output_directory, "run.log"), "rb")
+    except IOError:
+        return 0
+
+    # only one process updates the timeseries of a run at a time
+    lockfile = open(os.path.join(output_directory, LOG_TIMESERIES_STATE_FILENAME + ".lock"), "a")
+    fcntl.flock(lockfile, fcntl.LOCK_EX)
+    try:
+        signature = [[pattern.name, pattern.regex.pattern] for pattern in patterns]
+        state = _readState(output_directory)
+        if state is None or state['patterns'] != signature or not _logUnchanged(logfile, state):
+            _removeTimeseries(output_directory, patterns)
+            state = {'offset': 0, 'tail': "", 'patterns': signature}
+
+        num_matched = 0
+        offset = state['offset']
+        logfile.seek(offset)
+        remainder = ""
+        while True:
+            chunk = logfile.read(chunk_size)
+            if chunk == "":
+                break
+            text = remainder + chunk
+            # the last line may not have been completely written yet
+            end = text.rfind("\n") + 1
+            text, remainder = text[:end].replace("\010", ""), text[end:]
+
+            for pattern in patterns:
+                rows = pattern.findAll(text)
+                if len(rows) > 0:
+                    _appendRows(os.path.join(output_directory, LOG_TIMESERIES_FILENAME_FORMAT % pattern.name), pattern.dtype, rows)
+                    num_matched += len(rows)
+
+            offset = logfile.tell() - len(remainder)
+
+        logfile.seek(max(offset - _check_length, 0))
+        state['tail'] = logfile.read(min(offset, _check_length))
+        state['offset'] = offset
+        _writeState(output_directory, state)
+    finally:
+        fcntl.flock(lockfile, fcntl.LOCK_UN)
+        lockfile.close()
+        logfile.close()
+
+    return num_matched
+
+def loadLogTimeseries(output_directory, name, mmap_mode='r', dtype=float):
+    """
+    Load the timeseries `name` extracted from the log of the run in
+    `output_directory`. Returns an empty array of `dtype` (that of the
+    `LogPattern`) if nothing has been found (yet).
+    """
+    filename = os.path.join(output_directory, LOG_TIMESERIES_FILENAME_FORMAT % name)
+    if not os.path.exists(filename):
+        return np.zeros(0, dtype=dtype)
+    try:
+        return np.load(filename, mmap_mode=mmap_mode)
+    except ValueError:
+        # empty arrays can't be memory-mapped
+        return np.load(filename)
@@ -0,0 +1,351 @@
+"""
+Post-processing of output snapshots while runs are still going.
+
+An `OutputWatcher` watches the directories of running tasks for new output
+files matching the patterns callbacks were registered for, and calls those
+callbacks on each new snapshot in a pool of worker processes as soon as the
+solver has finished writing it::
+
+    def plot_snapshot(filename, output_directory):
+        pass  # e.g. plot the snapshot
+
+    watcher = OutputWatcher()
+    watcher.register('output_*.nc', plot_snapshot)
+    watcher.watchOutputBase('/data/runs')
+    watcher.run()
+
+On Linux changes are picked up through inotify, elsewhere (or when inotify
+isn't available) directories are polled: only those whose mtime has changed
+are listed again, and a file counts as complete once it hasn't been modified
+for `settle_time` seconds. Snapshots which have been handled are recorded in
+`postprocessing.log` in the run directory, so that they aren't processed
+again when the watcher is restarted. Callbacks must be functions defined at
+module level so that they can be sent to the worker processes.
+"""
+
+import os
+import time
+import errno
+import fnmatch
+import select
+import struct
+import ctypes
+import ctypes.util
+import multiprocessing
+
+import run_handling
+
+POSTPROCESSING_LOG_FILENAME = 'postprocessing.log'
+
+# inotify events, see inotify(7)
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+_inotify_event_header = struct.Struct("iIII")
+
+class InotifyBackend(object):
+    """
+    Reports changed directories (and files which have been completely
+    written) using inotify.
+    """
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(libc, 'inotify_init'):
+            raise OSError(errno.ENOSYS, "inotify isn't available")
+        self._libc = libc
+        self.fd = libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self._poller = select.poll()
+        self._poller.register(self.fd, select.POLLIN)
+        self._watches = {}
+
+    def add(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, path, IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_MODIFY)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Couldn't watch %s" % path)
+        self._watches[wd] = path
+
+    def remove(self, path):
+        for wd, watched_path in self._watches.items():
+            if watched_path == path:
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self._watches[wd]
+
+    def wait(self, timeout):
+        """
+        Wait for at most `timeout` seconds for changes, returns the directories
+        which changed and the files in them which have been closed after
+        writing. Returns None for the directories if events were lost.
+        """
+        changed_directories = set()
+        closed_files = set()
+        if len(self._poller.poll(int(timeout*1000.0))) == 0:
+            return changed_directories, closed_files
+
+        data = os.read(self.fd, 65536)
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _inotify_event_header.unpack_from(data, offset)
+            offset += _inotify_event_header.size
+            name = data[offset:offset+length].rstrip("\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                changed_directories = None
+                continue
+            path = self._watches.get(wd)
+            if path is None or mask & IN_IGNORED:
+                continue
+            if changed_directories is not None:
+                changed_directories.add(path)
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                closed_files.add(os.path.join(path, name))
+        return changed_directories, closed_files
+
+class PollingBackend(object):
+    """
+    Reports directories whose mtime has changed since they were last
+    checked, every `poll_interval` seconds.
+    """
+    def __init__(self, poll_interval=5.0):
+        self.poll_interval = poll_interval
+        self._mtimes = {}
+
+    def add(self, path):
+        self._mtimes.setdefault(path, None)
+
+    def remove(self, path):
+        self._mtimes.pop(path, None)
+
+    def wait(self, timeout):
+        time.sleep(min(timeout, self.poll_interval))
+        changed_directories = set()
+        for path, mtime in self._mtimes.items():
+            try:
+                new_mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if new_mtime != mtime:
+                self._mtimes[path] = new_mtime
+                changed_directories.add(path)
+        return changed_directories, set()
+
+def _runCallback(callback, filename, output_directory):
+    callback(filename, output_directory)
+
+def _callbackName(callback):
+    return "%s.%s" % (callback.__module__, callback.__name__)
+
+class WatchedRun(object):
+    """
+    A run directory being watched, with the snapshots handled so far.
+    """
+    def __init__(self, output_directory):
+        self.output_directory = output_directory
+        self.processed = set()
+        # snapshots handed to the workers but not done yet
+        self.in_progress = set()
+        self.candidates = {}
+
+        try:
+            fh = open(os.path.join(output_directory, POSTPROCESSING_LOG_FILENAME))
+        except IOError:
+            return
+        for line in fh:
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) == 3:
+                self.processed.add((fields[0], fields[1], float(fields[2])))
+        fh.close()
+
+    def recordProcessed(self, callback_name, filename, mtime):
+        self.processed.add((callback_name, filename, mtime))
+        fh = open(os.path.join(self.output_directory, POSTPROCESSING_LOG_FILENAME), "a")
+        fh.write("%s\t%s\t%r\n" % (callback_name, filename, mtime))
+        fh.close()
+
+class OutputWatcher(object):
+    """
+    Calls the callbacks registered with `register` on new output of the runs
+    being watched, using `processes` worker processes (one per core by
+    default). Runs added with `watch` or found by `watchOutputBase` are
+    watched for as long as they are running.
+    """
+    # how often runs are checked for having finished, and output bases for
+    # new runs (in seconds)
+    status_interval = 10.0
+
+    def __init__(self, processes=None, poll_interval=5.0, settle_time=2.0, use_inotify=True):
+        self.processes = processes
+        self.settle_time = settle_time
+        self.callbacks = []
+        self.runs = {}
+        self.output_directory_bases = []
+
+        self.backend = None
+        if use_inotify:
+            try:
+                self.backend = InotifyBackend()
+            except (OSError, AttributeError, TypeError):
+                pass
+        if self.backend is None:
+            self.backend = PollingBackend(poll_interval=poll_interval)
+
+        self._pool = None
+        self._pending = []
+        self._last_status_check = None
+
+    def register(self, pattern, callback):
+        """
+        Call `callback(filename, output_directory)` on every file matching
+        `pattern` (relative to the run directory, e.g. "output/*.nc").
+        """
+        self.callbacks.append((pattern, callback))
+
+    def _watchedDirectories(self, output_directory):
+        return set([os.path.normpath(os.path.join(output_directory, os.path.dirname(pattern))) for (pattern, _) in self.callbacks])
+
+    def watch(self, output_directory):
+        output_directory = os.path.normpath(output_directory)
+        if output_directory in self.runs:
+            return
+        self.runs[output_directory] = WatchedRun(output_directory)
+        self._addWatches(output_directory)
+        # pick up what was written before we started watching
+        self._scan(output_directory, self._watchedDirectories(output_directory), set())
+
+    def _addWatches(self, output_directory):
+        for path in self._watchedDirectories(output_directory):
+            try:
+                self.backend.add(path)
+            except OSError:
+                # e.g. output subdirectory not created yet, tried again later
+                pass
+
+    def watchOutputBase(self, output_directory_base):
+        """
+        Watch every run in `output_directory_base` which is running now, or
+        starts running later.
+        """
+        self.output_directory_bases.append(output_directory_base)
+        self._findRunningRuns(output_directory_base)
+
+    def _findRunningRuns(self, output_directory_base):
+        for name in os.listdir(output_directory_base):
+            output_directory = os.path.normpath(os.path.join(output_directory_base, name))
+            if output_directory in self.runs or not os.path.isdir(output_directory):
+                continue
+            if os.path.exists(os.path.join(output_directory, run_handling.LOCKFILE_FILENAME)):
+                if run_handling.classifyRunDirectory(output_directory) == 'running':
+                    self.watch(output_directory)
+
+    def _scan(self, output_directory, directories, closed_files, final=False):
+        """
+        Dispatch callbacks on the snapshots in `directories` of a run which
+        are complete and haven't been handled yet.
+        """
+        watched_run = self.runs[output_directory]
+        now = time.time()
+        for directory in directories:
+            try:
+                filenames = os.listdir(directory)
+            except OSError:
+                continue
+            for filename in filenames:
+                full_filename = os.path.join(directory, filename)
+                relative_filename = os.path.relpath(full_filename, output_directory)
+                for pattern, callback in self.callbacks:
+                    if fnmatch.fnmatch(relative_filename, pattern):
+                        watched_run.candidates[(relative_filename, _callbackName(callback))] = callback
+
+        for (relative_filename, callback_name), callback in watched_run.candidates.items():
+            full_filename = os.path.join(output_directory, relative_filename)
+            try:
+                mtime = os.stat(full_filename).st_mtime
+            except OSError:
+                del watched_run.candidates[(relative_filename, callback_name)]
+                continue
+            snapshot = (callback_name, relative_filename, mtime)
+            if snapshot in watched_run.processed or snapshot in watched_run.in_progress:
+                del watched_run.candidates[(relative_filename, callback_name)]
+                continue
+            if final or full_filename in closed_files or now - mtime >= self.settle_time:
+                del watched_run.candidates[(relative_filename, callback_name)]
+                self._dispatch(watched_run, callback, relative_filename, mtime)
+
+    def _dispatch(self, watched_run, callback, relative_filename, mtime):
+        if self._pool is None:
+            self._pool = multiprocessing.Pool(processes=self.processes)
+        result = self._pool.apply_async(_runCallback, (callback, os.path.join(watched_run.output_directory, relative_filename),
+                                                       watched_run.output_directory))
+        self._pending.append((result, watched_run, _callbackName(callback), relative_filename, mtime))
+        watched_run.in_progress.add((_callbackName(callback), relative_filename, mtime))
+
+    def _collectResults(self):
+        for item in list(self._pending):
+            result, watched_run, callback_name, relative_filename, mtime = item
+            if not result.ready():
+                continue
+            self._pending.remove(item)
+            watched_run.in_progress.discard((callback_name, relative_filename, mtime))
+            try:
+                result.get()
+            except Exception as e:
+                # not recorded, so that it is tried again when the watcher is restarted
+                print "%s failed on %s: %s" % (callback_name, os.path.join(watched_run.output_directory, relative_filename), str(e))
+            else:
+                watched_run.recordProcessed(callback_name, relative_filename, mtime)
+
+    def _checkRuns(self):
+        for output_directory_base in self.output_directory_bases:
+            self._findRunningRuns(output_directory_base)
+        for output_directory in self.runs.keys():
+            self._addWatches(output_directory)
+            if run_handling.classifyRunDirectory(output_directory) != 'running':
+                # whatever is there now is complete
+                self._scan(output_directory, self._watchedDirectories(output_directory), set(), final=True)
+                for path in self._watchedDirectories(output_directory):
+                    self.backend.remove(path)
+                del self.runs[output_directory]
+
+    def step(self, timeout=None):
+        if timeout is None:
+            if len(self._pending) > 0:
+                timeout = 0.5
+            elif any([len(watched_run.candidates) > 0 for watched_run in self.runs.values()]):
+                timeout = self.settle_time
+            else:
+                timeout = self.status_interval
+        changed_directories, closed_files = self.backend.wait(timeout)
+        for output_directory, watched_run in self.runs.items():
+            directories = self._watchedDirectories(output_directory)
+            if changed_directories is not None:
+                directories = directories & changed_directories
+            if len(directories) > 0 or len(watched_run.candidates) > 0:
+                self._scan(output_directory, directories, closed_files)
+
+        self._collectResults()
+        if self._last_status_check is None or time.time() - self._last_status_check >= self.status_interval:
+            self._checkRuns()
+            self._last_status_check = time.time()
+
+    def run(self, forever=False):
+        """
+        Watch until all runs being watched have finished and their output has
+        been processed (or forever, when watching output bases for new runs).
+        """
+        try:
+            while forever or len(self.runs) > 0 or len(self._pending) > 0:
+                self.step()
+        except:
+            if self._pool is not None:
+                self._pool.terminate()
+                self._pool = None
+            raise
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,150 @@
+"""
+Profiling of runscripts, see `RunfileBasedTaskRun`.
+
+This module is run as a script in place of the runscript of a task:
+
+    python profiling.py deterministic|sampling interval profile_filename runscript.py [args]
+
+and runs the runscript under either `cProfile` (every call is timed, which
+can slow down call-heavy code considerably) or a sampling profiler, which
+records the stack of the main thread every `interval` seconds of CPU time
+and adds very little overhead. Either way the profile is written in the
+format of `pstats` (so that the usual tools can be used to look at it),
+together with a summary of the functions in which most time was spent.
+
+Only the standard library is used here, as the runscript may be run by a
+different interpreter from the one which started the run.
+"""
+
+import os
+import sys
+import signal
+import marshal
+import pstats
+import StringIO
+
+PROFILE_MODES = ('deterministic', 'sampling')
+
+# number of functions listed in the summary
+SUMMARY_LIMIT = 30
+
+def getProfileCommand(python, mode, script, profile_filename, interval=0.005):
+    """
+    Command line running `script` with `python` under the profiler.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError("Profiling mode must be one of %s" % ", ".join(PROFILE_MODES))
+    runner = os.path.splitext(os.path.abspath(__file__))[0] + ".py"
+    return [python, runner, mode, str(interval), profile_filename, script]
+
+def getSummaryFilename(profile_filename):
+    return os.path.splitext(profile_filename)[0] + "_summary.txt"
+
+def writeProfileSummary(profile_filename, summary_filename=None, limit=SUMMARY_LIMIT):
+    """
+    Write the functions of the profile in `profile_filename` with the largest
+    own and cumulative times to a text file.
+    """
+    if summary_filename is None:
+        summary_filename = getSummaryFilename(profile_filename)
+    output = StringIO.StringIO()
+    stats = pstats.Stats(profile_filename, stream=output)
+    stats.strip_dirs()
+    output.write("Functions with most time spent in them (excluding the functions they call):\n")
+    stats.sort_stats('time').print_stats(limit)
+    output.write("Functions with most time spent in them (including the functions they call):\n")
+    stats.sort_stats('cumulative').print_stats(limit)
+
+    fh = open(summary_filename, "w")
+    fh.write(output.getvalue())
+    fh.close()
+
+class SamplingProfiler(object):
+    """
+    Samples the stack of the main thread every `interval` seconds of CPU time
+    (using `ITIMER_PROF`). Sample counts are turned into times when the stats
+    are written, as a `pstats` profile: a function's own time is the time in
+    which it was at the top of the stack and its cumulative time the time in
+    which it was on the stack at all.
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.num_samples = 0
+        self.own = {}
+        self.inclusive = {}
+        self.callers = {}
+        # frames from here down are the profiler's own
+        self._root_code = None
+
+    def _sample(self, signum, frame):
+        self.num_samples += 1
+        seen = set()
+        callee = None
+        while frame is not None and frame.f_code is not self._root_code:
+            code = frame.f_code
+            function = (code.co_filename, code.co_firstlineno, code.co_name)
+            if callee is None:
+                self.own[function] = self.own.get(function, 0) + 1
+            else:
+                callers = self.callers.setdefault(callee, {})
+                callers[function] = callers.get(function, 0) + 1
+            if function not in seen:
+                # recursive functions are only counted once per sample
+                self.inclusive[function] = self.inclusive.get(function, 0) + 1
+                seen.add(function)
+            callee = function
+            frame = frame.f_back
+
+    def start(self):
+        self._root_code = sys._getframe(1).f_code
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0.0, 0.0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def dump_stats(self, filename):
+        stats = {}
+        for function, count in self.inclusive.items():
+            own = self.own.get(function, 0)
+            callers = dict([(caller, (n, n, 0.0, n*self.interval)) for (caller, n) in self.callers.get(function, {}).items()])
+            stats[function] = (count, count, own*self.interval, count*self.interval, callers)
+        fh = open(filename, "wb")
+        marshal.dump(stats, fh)
+        fh.close()
+
+def runScript(mode, interval, profile_filename, script, args):
+    if mode == 'deterministic':
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.start = profiler.enable
+        profiler.stop = profiler.disable
+    else:
+        profiler = SamplingProfiler(interval)
+
+    # run as if the script had been started directly
+    sys.argv = [script] + args
+    sys.path[0] = os.path.dirname(os.path.abspath(script))
+    namespace = {'__name__': '__main__', '__file__': script, '__builtins__': __builtins__}
+    fh = open(script)
+    code = compile(fh.read(), script, 'exec')
+    fh.close()
+
+    profiler.start()
+    try:
+        exec code in namespace
+    finally:
+        profiler.stop()
+        profiler.dump_stats(profile_filename)
+        try:
+            writeProfileSummary(profile_filename)
+        except (TypeError, ValueError):
+            # nothing was recorded (e.g. no samples from a very short run)
+            pass
+
+if __name__ == "__main__":
+    if len(sys.argv) < 5 or sys.argv[1] not in PROFILE_MODES:
+        print "Usage: %s %s interval profile_filename script [args]" % (sys.argv[0], "|".join(PROFILE_MODES))
+        sys.exit(1)
+    runScript(mode=sys.argv[1], interval=float(sys.argv[2]), profile_filename=sys.argv[3], script=sys.argv[4], args=sys.argv[5:])
@@ -1,3 +1,5 @@
+import time
+import bisect
 import warnings
 import numpy as np
 import scipy.constants
@@ -48,6 +50,103 @@ def getIsentropicAtmosphere(theta0=300.0, g=9.81, p0=1.0e6):
     dTdz = -g/gas_properties.cp()
     return HydrostaticallyBalancedAtmosphere(rho0=rho0, p0=p0, dTdz=dTdz, gas_properties=gas_properties, g=g)
 
+def _broadcastTo(a, shape):
+    """
+    Read-only view of `a` broadcast to `shape`, without copying (the same as
+    `np.broadcast_to`, which isn't available in older numpy versions).
+    """
+    a = np.asarray(a)
+    shape = tuple(shape)
+    error = ValueError("Can't broadcast an array of shape %s to %s" % (a.shape, shape))
+    if a.ndim > len(shape):
+        raise error
+    a = a.reshape((1,)*(len(shape) - a.ndim) + a.shape)
+    strides = []
+    for n, m, stride in zip(a.shape, shape, a.strides):
+        if n == m:
+            strides.append(stride)
+        elif n == 1:
+            strides.append(0)
+        else:
+            raise error
+    view = np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides)
+    view.flags.writeable = False
+    return view
+
+def _isConstantAlong(z, axis):
+    slices = np.rollaxis(z, axis, 0)
+    # most axes along which height changes are found without a full pass
+    if not np.array_equal(slices[-1], slices[0]):
+        return False
+    for n in range(1, len(slices) - 1):
+        if not np.array_equal(slices[n], slices[0]):
+            return False
+    return True
+
+def _reduceToColumns(z):
+    """
+    Smallest slice of the heights `z` which broadcasts back to `z`, i.e.
+    with the axes along which the height doesn't change (the horizontal axes
+    of a regular grid) reduced to length one.
+    """
+    for axis in range(z.ndim):
+        if z.shape[axis] == 1:
+            continue
+        if z.strides[axis] == 0 or _isConstantAlong(z, axis):
+            index = [slice(None)]*z.ndim
+            index[axis] = slice(0, 1)
+            z = z[tuple(index)]
+    return z
+
+def evaluateColumnwise(f, z, shape=None):
+    """
+    Evaluate the profile function `f` (e.g. `profile.temp`) at the heights
+    `z`, computing the value at each distinct height of the grid only once.
+
+    `z` is either the heights at every grid point (e.g. `pos[-1]` of a 3D
+    grid) or the vertical coordinate alone together with the grid `shape` it
+    should be broadcast to (e.g. `z[None,None,:]` for `shape=(nx, ny, nz)`).
+    As all profiles only depend on height, the result is a read-only
+    broadcast view of the shape of the grid, which only takes up the memory
+    of a single column. Copy it if it needs to be modified.
+    """
+    z = np.asarray(z)
+    if shape is not None:
+        z = _broadcastTo(z, shape)
+    z_columns = _reduceToColumns(z)
+    values = np.asarray(f([z_columns.ravel()]))
+    if values.size == z_columns.size:
+        values = values.reshape(z_columns.shape)
+    return _broadcastTo(values, z.shape)
+
+def benchmarkColumnwise(profile, n=256, variables=('temp', 'rho', 'p'), z_max=10.0e3):
+    """
+    Compare evaluating `variables` of `profile` on a n^3 grid point by point
+    with `evaluateColumnwise`, both detecting the columns in the full height
+    array and given the vertical coordinate alone. Returns the time taken
+    and memory used by the result (in bytes) for each.
+    """
+    z_column = np.linspace(0.0, z_max, n)
+    z = np.ascontiguousarray(_broadcastTo(z_column, (n, n, n)))
+
+    methods = [
+        ('pointwise', lambda f: np.asarray(f([z]))),
+        ('columnwise (detected)', lambda f: evaluateColumnwise(f, z)),
+        ('columnwise (1D z)', lambda f: evaluateColumnwise(f, z_column, shape=z.shape)),
+    ]
+
+    timings = {}
+    for name, evaluate in methods:
+        t0 = time.time()
+        nbytes = 0
+        for variable in variables:
+            values = evaluate(getattr(profile, variable))
+            # broadcast views only take up memory along their non-zero strides
+            nbytes += np.prod([l for (l, stride) in zip(values.shape, values.strides) if stride != 0])*values.itemsize
+        timings[name] = (time.time() - t0, nbytes)
+        print "%s: %.3fs, %.3gMB" % (name, timings[name][0], nbytes/1.0e6)
+    return timings
+
 
 class HydrostaticallyBalancedAtmosphere(object):
     """
@@ -151,8 +250,13 @@ class AttrDict:
 
 
 class LayeredAtmosphere(object):
+    # for unordered heights and at most this many layers, comparing the
+    # heights with the boundaries of each layer in turn is quicker than
+    # looking up the layer of every height
+    max_layers_compared = 16
+
     def __init__(self, layers):
-        self.layer_instances = {}
+        layer_instances = []
 
         # ground state
         z_min = 0.0
@@ -160,22 +264,88 @@ class LayeredAtmosphere(object):
             z_max = layer['z_max']
             z = (z_min, z_max)
             layer_instance = AttrDict(layer)
-            self.layer_instances[z] = layer_instance
+            layer_instances.append((z, layer_instance))
 
             # calculate the start values of the next layer, remember that this
             # layer is offset.
             z_offset = z_max - z_min
             z_min = z_max
 
+        self._set_layers(layer_instances)
+
+    def _set_layers(self, layer_instances):
+        """
+        Store the layers, given as a list of ((z_min, z_max), layer) from the
+        ground up, as sorted arrays of their boundaries so that the layer
+        containing a height can be found by bisection.
+        """
+        self.layer_instances = dict(layer_instances)
+        self._layers = [layer for (_, layer) in layer_instances]
+        self._layers_z_min = np.array([z_min for ((z_min, _), _) in layer_instances])
+        self._layers_z_max = np.array([z_max for ((_, z_max), _) in layer_instances])
+        # bisecting a list is quicker than `np.searchsorted` for single values
+        self._layers_z_min_list = [float(z_min) for z_min in self._layers_z_min]
+        self._layers_z_max_list = [float(z_max) for z_max in self._layers_z_max]
+        if np.any(self._layers_z_max <= self._layers_z_min) or np.any(self._layers_z_min[1:] < self._layers_z_max[:-1]):
+            raise ValueError("Layers must be given in order of increasing height and must not overlap")
+
+        # the layer between each pair of consecutive boundaries, -1 for gaps
+        # between layers and for below and above all of them
+        boundaries = sorted(set(self._layers_z_min_list) | set(self._layers_z_max_list))
+        self._boundaries = np.array(boundaries)
+        self._boundary_layers = -np.ones(len(boundaries) + 1, dtype=np.int32)
+        for n, z_min in enumerate(self._layers_z_min_list):
+            self._boundary_layers[boundaries.index(z_min) + 1] = n
+
+    def _find_layer(self, z):
+        """
+        Index of the layer containing the height `z`, or None if it is outside
+        of all layers. The top of the topmost layer is included in it.
+        """
+        n = bisect.bisect_right(self._layers_z_min_list, z) - 1
+        if n < 0 or z > self._layers_z_max_list[n]:
+            return None
+        return n
+
+    def _get_values_at_heights(self, variable, z):
+        """
+        Evaluate `variable` of the layers at the heights `z` (an array), with
+        each layer's function called once on all heights within that layer.
+        Heights outside of all layers are given the value zero.
+        """
+        z = np.asarray(z)
+        z_flat = z.ravel()
+
+        if np.all(z_flat[1:] >= z_flat[:-1]):
+            # e.g. a single column, the points of each layer are a slice
+            start = np.searchsorted(z_flat, self._layers_z_min, side='left')
+            end = np.searchsorted(z_flat, self._layers_z_max, side='left')
+            points_in_layer = lambda n: slice(start[n], end[n])
+        elif len(self._layers) <= self.max_layers_compared:
+            points_in_layer = lambda n: np.logical_and(self._layers_z_min[n] <= z_flat, z_flat < self._layers_z_max[n])
+        else:
+            # find the layer of every point in one pass
+            layer_index = np.take(self._boundary_layers, np.searchsorted(self._boundaries, z_flat, side='right'))
+            points_in_layer = lambda n: np.flatnonzero(layer_index == n)
+
+        values = np.zeros(z_flat.shape)
+        for n, layer in enumerate(self._layers):
+            idx_in_layer = points_in_layer(n)
+            z_in_layer = z_flat[idx_in_layer]
+            if len(z_in_layer) > 0:
+                f = getattr(layer, variable)
+                values[idx_in_layer] = np.ravel(f([z_in_layer - self._layers_z_min[n]]))
+        return values.reshape(z.shape)
+
     def _get_values_from_layer(self, variable, pos):
 
-        if type(pos) in [float, np.float, np.float64 ]:
+        if np.isscalar(pos):
             z = pos
 
-            for (z_min, z_max), layer in self.layer_instances.items():
-                if z_min <= z and z <= z_max:
-                    f = getattr(layer, variable)
-                    return f(z - z_min)
+            n = self._find_layer(z)
+            if n is not None:
+                f = getattr(self._layers[n], variable)
+                return f(z - self._layers_z_min_list[n])
 
         else:
             pos = np.array(pos)
@@ -184,14 +354,7 @@ class LayeredAtmosphere(object):
             else:
                 z = pos
 
-            values = np.zeros(z.shape)
-
-            for (z_min, z_max), layer in self.layer_instances.items():
-                idx_in_layer = np.logical_and(z_min <= z, z < z_max)
-                f = getattr(layer, variable)
-                values[idx_in_layer] = f([z[idx_in_layer] - z_min])
-
-            return values
+            return self._get_values_at_heights(variable, z)
 
 class LayeredDryAtmosphere(LayeredAtmosphere):
     def __init__(self, layers, rho0=None, p0=None, gas_properties=None):
@@ -203,7 +366,7 @@ class LayeredDryAtmosphere(LayeredAtmosphere):
 
         # create an instance of HydroststaticallyBalancedAtmosphere for
         # each layer
-        self.layer_instances = {}
+        layer_instances = []
 
         # ground state
         z_min = 0.0
@@ -219,7 +382,7 @@ class LayeredDryAtmosphere(LayeredAtmosphere):
                                                                dTdz=layer['dTdz'],
                                                                gas_properties=self.gas_properties,
                                                                )
-            self.layer_instances[z] = layer_instance
+            layer_instances.append((z, layer_instance))
 
             # calculate the start values of the next layer, remember that this
             # layer is offset.
@@ -228,6 +391,8 @@ class LayeredDryAtmosphere(LayeredAtmosphere):
             rho0 = layer_instance.rho([z_offset])
             p0 = layer_instance.p([z_offset])
 
+        self._set_layers(layer_instances)
+
     def temp(self, pos):
         return self._get_values_from_layer('temp', pos)
 
@@ -272,7 +437,7 @@ class LayeredStable(LayeredDryAtmosphere):
     def __str__(self):
         return "Very stable two-layered atmosphere"
 
-class LayeredMoistAtmosphere(object):
+class LayeredMoistAtmosphere(LayeredAtmosphere):
     def __init__(self, layers, RH0, RH_min=None, rho0=None, p0=None):
         self.layers = layers
         self.RH_min = RH_min
@@ -281,7 +446,7 @@ class LayeredMoistAtmosphere(object):
 
         # create an instance of HydrostHydrostaticallyBalancedAtmosphere for
         # each layer
-        self.layer_instances = {}
+        layer_instances = []
 
         # ground state
         z_min = 0.0
@@ -300,7 +465,7 @@ class LayeredMoistAtmosphere(object):
                                                                     RH0=RH0,
                                                                     gas_properties=self.gas_properties,
                                                                     )
-            self.layer_instances[z] = layer_instance
+            layer_instances.append((z, layer_instance))
 
             # calculate the start values of the next layer, remember that this
             # layer is offset.
@@ -310,6 +475,8 @@ class LayeredMoistAtmosphere(object):
             p0 = layer_instance.p([z_offset])
             RH0 = layer_instance.rel_humidity([z_offset])
 
+        self._set_layers(layer_instances)
+
     def temp(self, pos):
         return self._get_values_from_layer('temp', pos)
 
@@ -326,20 +493,13 @@ class LayeredMoistAtmosphere(object):
         else:
             z = pos
 
-        try:
-            values = np.zeros(z.shape)
-
-            for (z_min, z_max), layer in self.layer_instances.items():
-                idx_in_layer = np.logical_and(z_min <= z, z < z_max)
-                f = getattr(layer, variable)
-                values[idx_in_layer] = f([z[idx_in_layer] - z_min])
-
-            return values
-        except AttributeError:
-            for (z_min, z_max), layer in self.layer_instances.items():
-                if z_min <= z and z <= z_max:
-                    f = getattr(layer, variable)
-                    return f([z - z_min])
+        if np.isscalar(z):
+            n = self._find_layer(z)
+            if n is not None:
+                f = getattr(self._layers[n], variable)
+                return f([z - self._layers_z_min_list[n]])
+        else:
+            return self._get_values_at_heights(variable, z)
 
 
     def rel_humidity(self, pos):
@@ -8,3 +8,55 @@ def test_RICO():
     assert profile.temp(0.0) == 299.2
     assert profile.q_t(0.0) == 0.016
     assert profile.temp(0.0) > profile.temp(1000.)
+
+def test_evaluate_columnwise():
+    profile = stratification_profiles.getStandardIsentropicAtmosphere()
+    pos = np.mgrid[0:1:4j, 0:1:5j, 0:5000:7j]
+
+    temp = stratification_profiles.evaluateColumnwise(profile.temp, pos[-1])
+    assert temp.shape == pos[-1].shape
+    assert np.allclose(temp, profile.temp(pos))
+    # only one column is stored
+    assert temp.strides[:2] == (0, 0)
+
+    rho = stratification_profiles.evaluateColumnwise(profile.rho, np.linspace(0., 5000., 7), shape=pos[-1].shape)
+    assert np.allclose(rho, profile.rho(pos))
+
+def test_evaluate_columnwise_varying_horizontally():
+    profile = stratification_profiles.LayeredStable()
+    pos = np.mgrid[0:1:4j, 0:1:5j, 0:5000:7j]
+    z = pos[-1].copy()
+    z[1,2,:] += 100.
+
+    assert np.allclose(stratification_profiles.evaluateColumnwise(profile.p, z), profile.p([z]))
+
+def test_layer_lookup():
+    layers = [
+        {'z_max': 100., 'n': lambda z: np.ones_like(z, dtype=float)},
+        {'z_max': 200., 'n': lambda z: 2.*np.ones_like(z, dtype=float)},
+        {'z_max': 300., 'n': lambda z: 3.*np.ones_like(z, dtype=float)},
+    ]
+    profile = stratification_profiles.LayeredAtmosphere(layers)
+    z = np.array([250., -10., 0., 99., 100., 150., 200., 299., 300., 400.])
+    expected = np.array([3., 0., 1., 1., 2., 2., 3., 3., 0., 0.])
+
+    assert np.all(profile._get_values_from_layer('n', z) == expected)
+    profile.max_layers_compared = 0
+    assert np.all(profile._get_values_from_layer('n', z) == expected)
+    assert np.all(profile._get_values_from_layer('n', [z.reshape(2, 5)]) == expected.reshape(2, 5))
+
+    order = np.argsort(z)
+    assert np.all(profile._get_values_from_layer('n', z[order]) == expected[order])
+
+    assert profile._get_values_from_layer('n', 150.) == 2.
+    # the top of the topmost layer is included for single heights
+    assert profile._get_values_from_layer('n', 300.) == 3.
+    assert profile._get_values_from_layer('n', 400.) is None
+
+def test_layered_moist_lookup():
+    profile = stratification_profiles.Soong1973()
+    z = np.array([12800., 0., 500., 800., 5000., 20000.])
+
+    temp = profile.temp([z])
+    for z_, temp_ in zip(z, temp):
+        assert np.allclose(profile.temp(z_), temp_)
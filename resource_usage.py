@@ -0,0 +1,235 @@
+"""
+Measuring how much CPU time, memory and I/O a run uses.
+
+While a run is going a `ResourceMonitor` samples the process running the
+task, together with all processes it has started (e.g. MPI ranks), and
+appends the totals to `resource_usage.csv` in the run directory:
+
+    time, run, num_processes, cpu_user, cpu_system, rss, read_bytes, write_bytes
+
+with times in seconds and sizes in bytes. Sampling reads `/proc` and so only
+works on Linux, elsewhere only the final resource usage is recorded. When a
+process exits the rusage returned by `wait4` is stored in `rusage.yml`, one
+entry per run of the task.
+"""
+
+import os
+import errno
+import time
+import threading
+import resource
+
+import yaml
+
+RESOURCE_USAGE_FILENAME = 'resource_usage.csv'
+RUSAGE_FILENAME = 'rusage.yml'
+
+_csv_columns = ('time', 'run', 'num_processes', 'cpu_user', 'cpu_system', 'rss', 'read_bytes', 'write_bytes')
+_rusage_fields = ('ru_utime', 'ru_stime', 'ru_maxrss', 'ru_minflt', 'ru_majflt', 'ru_inblock', 'ru_oublock', 'ru_nvcsw', 'ru_nivcsw')
+
+_clock_ticks = os.sysconf('SC_CLK_TCK')
+_page_size = resource.getpagesize()
+
+def _readProcStat(pid):
+    """
+    Returns (state, ppid, utime, stime, rss) of process `pid`, with times in
+    seconds and rss in bytes.
+    """
+    fh = open("/proc/%d/stat" % pid)
+    content = fh.read()
+    fh.close()
+    # the command name may contain spaces, the remaining fields don't
+    fields = content[content.rindex(")")+2:].split()
+    return (fields[0], int(fields[1]), float(fields[11])/_clock_ticks, float(fields[12])/_clock_ticks, int(fields[21])*_page_size)
+
+def _readProcIO(pid):
+    try:
+        fh = open("/proc/%d/io" % pid)
+    except IOError:
+        # not allowed to look at other users' processes
+        return (0, 0)
+    io = {}
+    for line in fh:
+        key, value = line.split(":")
+        io[key] = int(value)
+    fh.close()
+    return (io.get('read_bytes', 0), io.get('write_bytes', 0))
+
+def findChildProcesses():
+    """
+    Map from the pid of every process to the pids of its children.
+    """
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid = _readProcStat(int(entry))[1]
+        except (IOError, ValueError, IndexError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    return children
+
+def _findProcessTree(pid, children):
+    tree = [pid]
+    i = 0
+    while i < len(tree):
+        tree.extend(children.get(tree[i], []))
+        i += 1
+    return tree
+
+def sampleProcessTree(pid, include_children=True, children=None):
+    """
+    Total resource usage of process `pid` and (optionally) all its
+    descendants, returned as (num_processes, cpu_user, cpu_system, rss,
+    read_bytes, write_bytes). Returns None if `pid` is gone. When sampling
+    many processes at once the output of `findChildProcesses` can be passed
+    in as `children`, so that `/proc` is only scanned once.
+    """
+    if include_children:
+        if children is None:
+            children = findChildProcesses()
+        pids = _findProcessTree(pid, children)
+    else:
+        pids = [pid]
+
+    totals = [0, 0.0, 0.0, 0, 0, 0]
+    for p in pids:
+        try:
+            state, _, utime, stime, rss = _readProcStat(p)
+            read_bytes, write_bytes = _readProcIO(p)
+        except (IOError, ValueError, IndexError):
+            # exited since we listed it
+            continue
+        if state == 'Z':
+            # exited, but not reaped yet
+            continue
+        for n, value in enumerate([1, utime, stime, rss, read_bytes, write_bytes]):
+            totals[n] += value
+
+    if totals[0] == 0:
+        return None
+    return tuple(totals)
+
+def _exitStatusToReturncode(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    else:
+        return os.WEXITSTATUS(status)
+
+def waitWithRusage(process):
+    """
+    Wait for the `subprocess.Popen` instance `process` to exit, returning the
+    rusage of the process (and the children it waited for). The return code
+    is set on `process` as `wait` would.
+    """
+    if process.returncode is not None:
+        # already reaped elsewhere, the rusage is gone
+        return None
+    while True:
+        try:
+            _, status, rusage = os.wait4(process.pid, 0)
+            break
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+    process.returncode = _exitStatusToReturncode(status)
+    return rusage
+
+def pollWithRusage(process):
+    """
+    Like `waitWithRusage`, but returns straight away. Returns (returncode,
+    rusage) once the process has exited and (None, None) while it is running.
+    """
+    if process.returncode is not None:
+        return process.returncode, None
+    pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+    if pid == 0:
+        return None, None
+    process.returncode = _exitStatusToReturncode(status)
+    return process.returncode, rusage
+
+class ResourceMonitor(object):
+    """
+    Samples the resource usage of the process running a task every `interval`
+    seconds, and records the final rusage of each run of the task. Sampling
+    happens in a background thread unless `sampling_thread` is False, in
+    which case `sample` must be called periodically by the owner.
+    """
+    include_children = True
+
+    def __init__(self, output_directory, interval=10.0, sampling_thread=True):
+        self.output_directory = output_directory
+        self.interval = interval
+        self.sampling_thread = sampling_thread
+        self.can_sample = os.path.exists("/proc/self/stat")
+
+        self.run = -1
+        self.pid = None
+        self.start_time = None
+        self.last_sample = None
+        self.rusage = []
+
+        self._stop = None
+        self._thread = None
+
+    def start(self, pid):
+        self.run += 1
+        self.pid = pid
+        if self.start_time is None:
+            self.start_time = time.time()
+
+        filename = os.path.join(self.output_directory, RESOURCE_USAGE_FILENAME)
+        write_header = not os.path.exists(filename)
+        self.csvfile = open(filename, "a")
+        if write_header:
+            self.csvfile.write(",".join(_csv_columns) + "\n")
+
+        if self.can_sample and self.sampling_thread:
+            self._stop = threading.Event()
+            self._thread = threading.Thread(target=self._sampleUntilStopped)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _sampleUntilStopped(self):
+        while True:
+            self.sample()
+            if self._stop.wait(self.interval):
+                break
+
+    def sample(self, children=None):
+        if not self.can_sample or self.pid is None:
+            return
+        self.last_sample = time.time()
+        usage = sampleProcessTree(self.pid, include_children=self.include_children, children=children)
+        if usage is None:
+            return
+        self.csvfile.write("%.2f,%d,%d,%.2f,%.2f,%d,%d,%d\n" % ((self.last_sample - self.start_time, self.run) + usage))
+        self.csvfile.flush()
+
+    def isDue(self):
+        """
+        True if the next sample should be taken (when sampling from outside).
+        """
+        if not self.can_sample or self.pid is None:
+            return False
+        return self.last_sample is None or time.time() - self.last_sample >= self.interval
+
+    def finish(self, rusage):
+        """
+        Stop sampling the current run and record its final `rusage` (as
+        returned by `waitWithRusage`).
+        """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.pid = None
+        self.csvfile.close()
+
+        if rusage is not None:
+            self.rusage.append(dict([(field, getattr(rusage, field)) for field in _rusage_fields]))
+            fh = open(os.path.join(self.output_directory, RUSAGE_FILENAME), "w")
+            yaml.safe_dump(self.rusage, fh, default_flow_style=False)
+            fh.close()
@@ -6,26 +6,41 @@ settings.
 """
 
 import os
+import re
+import errno
+import fcntl
 import time
 import subprocess
 import yaml
 import fnmatch
 import glob
 import getpass
+import hashlib
+import cPickle
 import warnings
 import inspect
+import collections
 import multiprocessing
+import select
+import socket
 import sys
+import threading
 
 from subprocess import Popen, PIPE
-from threading  import Thread
 
 import __builtin__
 
+import resource_usage
+import log_parsing
+import profiling
+import yaml_serialize
+
+HAS_LSC_TASKER = False
 try:
     import lsc_tasker
     import lsc_tasker.utils
     # TODO: These need refactoring from the codebase I wrote at the start of my PhD
+    HAS_LSC_TASKER = True
 except ImportError:
     pass
 
@@ -35,16 +50,59 @@ try:
 except ImportError:
     pass
 
+OUTPUT_DIRECTORY_COUNTER_FILENAME = '.task_counter'
+
 def getFreeOutputDirectory(output_directory_base):
-    # find free output directory
-    n = 0
-    output_dir = os.path.join(output_directory_base, "task_%s/" % (time.strftime("%Y%m%d_%H%M%S")))
-    while True:
-        if os.path.exists(output_dir):
-            output_dir = os.path.join(output_directory_base, "task_%s_%i/" % (time.strftime("%Y%m%d_%H%M%S"), n))
-            n += 1
+    """
+    Claim a new output directory in `output_directory_base`, named after the
+    current time, and return its path. The directory is created here, with
+    `os.mkdir` failing if it already exists, so the same directory can never be
+    handed out twice, whichever processes are allocating.
+
+    The timestamp and suffix of the last directory claimed are kept in a
+    counter file in `output_directory_base`, which is only updated while
+    holding an exclusive lock, so the next free name is known without having
+    to probe for existing directories.
+    """
+    try:
+        os.makedirs(output_directory_base)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    counter_filename = os.path.join(output_directory_base, OUTPUT_DIRECTORY_COUNTER_FILENAME)
+    fh = os.fdopen(os.open(counter_filename, os.O_RDWR | os.O_CREAT), "r+")
+    fcntl.flock(fh, fcntl.LOCK_EX)
+    try:
+        timestamp = time.strftime("%Y%m%d_%H%M%S")
+        counter = fh.read().split()
+        if len(counter) == 2 and counter[0] == timestamp:
+            n = int(counter[1]) + 1
         else:
-            break
+            # -1 means no suffix, the first directory in any second
+            n = -1
+
+        while True:
+            if n < 0:
+                output_dir = os.path.join(output_directory_base, "task_%s/" % timestamp)
+            else:
+                output_dir = os.path.join(output_directory_base, "task_%s_%i/" % (timestamp, n))
+            try:
+                os.mkdir(output_dir)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                n += 1
+
+        fh.seek(0)
+        fh.truncate()
+        fh.write("%s %d\n" % (timestamp, n))
+        fh.flush()
+    finally:
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        fh.close()
+
     return output_dir
 
 class TaskRunfile():
@@ -55,45 +113,520 @@ class TaskRunfile():
         return "%s: %s" % (self.name, self.description)
 
 class LogEmitter(object):
+    """
+    Wraps the logfile of a run. Backspace characters (from progress counters)
+    are dropped from any output written through `write`; output which a child
+    process writes straight to `fileno` is cleaned up with `stripBackspaces`
+    once the run has finished.
+    """
     def __init__(self, logfile):
         self.logfile = logfile
     def write(self, text):
-        print text
-        #self.logfile.write(text)
-        #self.logfile.flush()
+        self.logfile.write(text.replace("\010", ""))
+    def flush(self):
+        self.logfile.flush()
     def fileno(self):
         return self.logfile.fileno()
 
-# http://stackoverflow.com/questions/4984428/python-subprocess-get-childrens-output-to-file-and-terminal/4985080#4985080
-def tee(infile, *files):
-    """Print `infile` to `files` in a separate thread."""
-    def fanout(infile, *files):
-        for line in iter(infile.readline, ''):
-            for f in files:
-                f.write(line)
-        infile.close()
-    t = Thread(target=fanout, args=(infile,)+files)
-    t.daemon = True
-    t.start()
-    return t
+def stripBackspaces(filename, chunk_size=1048576):
+    """
+    Remove all backspace characters from `filename` in place. The file is
+    compacted one chunk at a time, so memory use doesn't depend on the size of
+    the file, and nothing is written until the first backspace is found.
+    """
+    fh = open(filename, "r+b")
+    try:
+        read_pos = 0
+        write_pos = 0
+        while True:
+            fh.seek(read_pos)
+            chunk = fh.read(chunk_size)
+            if chunk == "":
+                break
+            read_pos += len(chunk)
+
+            cleaned_chunk = chunk.replace("\010", "")
+            if write_pos + len(chunk) == read_pos and len(cleaned_chunk) == len(chunk):
+                # nothing removed so far, the chunk is already in place
+                write_pos = read_pos
+                continue
+
+            fh.seek(write_pos)
+            fh.write(cleaned_chunk)
+            write_pos += len(cleaned_chunk)
+
+        fh.truncate(write_pos)
+    finally:
+        fh.close()
+
+RUN_STATUS_FILENAME = 'run_status.yml'
+RUN_PROGRESS_FILENAME = 'run_progress.yml'
+
+def _writeYamlFile(filename, content):
+    fh = open(filename, "w")
+    yaml.safe_dump(content, fh, default_flow_style=False)
+    fh.close()
+
+def openRunFile(filename):
+    """
+    Open `filename` in a run directory for reading, or the corresponding
+    member of the run's archive if the run has been archived (see
+    `task_archive`).
+    """
+    try:
+        return open(filename, "rb")
+    except IOError:
+        import task_archive
+        fh = task_archive.openArchivedFile(filename)
+        if fh is None:
+            raise
+        return fh
+
+def _readYamlFile(filename):
+    try:
+        fh = openRunFile(filename)
+    except IOError:
+        return None
+    try:
+        return yaml.safe_load(fh)
+    finally:
+        fh.close()
+
+def writeRunStatus(output_directory, **status):
+    """
+    Record the outcome of a run in a small status file in its output
+    directory, so that it can be checked without reading the log.
+    """
+    _writeYamlFile(os.path.join(output_directory, RUN_STATUS_FILENAME), status)
+
+def readRunStatus(output_directory):
+    """
+    Return the status recorded for the run in `output_directory`, or None if
+    the run hasn't finished (or finished before status files were written).
+    """
+    return _readYamlFile(os.path.join(output_directory, RUN_STATUS_FILENAME))
+
+def writeRunProgress(output_directory, **progress):
+    """
+    Record how far a task with repeated runs has got, updated every time one
+    of the runs completes so that an interrupted task can be resumed.
+    """
+    _writeYamlFile(os.path.join(output_directory, RUN_PROGRESS_FILENAME), progress)
+
+def readRunProgress(output_directory):
+    return _readYamlFile(os.path.join(output_directory, RUN_PROGRESS_FILENAME))
+
+CONTENT_INDEX_DIRNAME = '.content_index'
+
+def _contentIndexFilename(output_directory_base, content_hash):
+    return os.path.join(output_directory_base, CONTENT_INDEX_DIRNAME, content_hash)
+
+def registerCompletedRun(output_directory, content_hash):
+    """
+    Add the completed run in `output_directory` to the index of runs by
+    content hash (see `BaseTask.getContentHash`) kept in its output base.
+    """
+    output_directory = os.path.normpath(output_directory)
+    index_filename = _contentIndexFilename(os.path.dirname(output_directory), content_hash)
+    try:
+        os.makedirs(os.path.dirname(index_filename))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # the index entry is a relative symlink to the run, so that the output
+    # base can be moved, replaced atomically if there already is one
+    tmp_filename = "%s.%d.tmp" % (index_filename, os.getpid())
+    os.symlink(os.path.join(os.pardir, os.path.basename(output_directory)), tmp_filename)
+    os.rename(tmp_filename, index_filename)
+
+def findCompletedRun(output_directory_base, content_hash):
+    """
+    Return the output directory of a completed run in `output_directory_base`
+    with the given content hash, or None if there is none.
+    """
+    index_filename = _contentIndexFilename(output_directory_base, content_hash)
+    try:
+        output_directory = os.path.normpath(os.path.join(os.path.dirname(index_filename), os.readlink(index_filename)))
+    except OSError:
+        return None
+
+    run_status = readRunStatus(output_directory)
+    if run_status is None or not run_status.get('complete') or run_status.get('content_hash') != content_hash:
+        # removed, or rerun since it was indexed
+        return None
+    # with a trailing slash like those from `getFreeOutputDirectory`
+    return os.path.join(output_directory, '')
+
+# e.g. "Total time  : 12.5s"
+_run_duration_re = re.compile(r"Total time\s*[:=]\s*([0-9.eE+-]+)s")
+
+def _parseRunDuration(line):
+    """
+    Run duration (in seconds) from a "Total time" line, None if `line` isn't
+    one (or can't be parsed).
+    """
+    match = _run_duration_re.search(line)
+    if match is None:
+        return None
+    try:
+        return float(match.group(1))
+    except ValueError:
+        return None
+
+def findRunDurationInLog(log_filename, max_bytes=1048576, block_size=65536):
+    """
+    Find the "Total time" line, which solvers print when they finish, by
+    reading `log_filename` backwards from the end. Only the last `max_bytes`
+    are searched, so this takes the same time however long the log is.
+    """
+    try:
+        fh = open(log_filename, "rb")
+    except IOError:
+        # members of archived runs can only be read from the start
+        fh = openRunFile(log_filename)
+        try:
+            run_duration = None
+            for line in fh:
+                if "Total time" in line and _parseRunDuration(line) is not None:
+                    run_duration = _parseRunDuration(line)
+            return run_duration
+        finally:
+            fh.close()
+
+    try:
+        fh.seek(0, os.SEEK_END)
+        pos = fh.tell()
+        start = max(0, pos - max_bytes)
+
+        partial_line = ""
+        while pos > start:
+            read_size = min(block_size, pos - start)
+            pos -= read_size
+            fh.seek(pos)
+            lines = (fh.read(read_size) + partial_line).split("\n")
+
+            # the first line is only known to be complete at the start of the file
+            if pos > 0:
+                partial_line = lines.pop(0)
+            else:
+                partial_line = ""
+
+            for line in reversed(lines):
+                if "Total time" in line:
+                    run_duration = _parseRunDuration(line)
+                    if run_duration is not None:
+                        return run_duration
+        return None
+    finally:
+        fh.close()
+
+LOCKFILE_FILENAME = 'is_running.lock'
+
+class RunLockedError(Exception):
+    pass
+
+class RunLock(object):
+    """
+    Lockfile marking a run as in progress. The lockfile holds the pid and
+    hostname of the process running the task together with a heartbeat
+    timestamp, and an exclusive `fcntl` lock is held on it for as long as the
+    run is going. The heartbeat is refreshed every `heartbeat_interval`
+    seconds, either from a background thread or by calling `refresh`, so
+    that runs which died without cleaning up can be told apart from live
+    ones (see `scanRunDirectories`).
+    """
+    heartbeat_interval = 30.0
+
+    def __init__(self, output_directory, heartbeat_interval=None):
+        self.filename = os.path.join(output_directory, LOCKFILE_FILENAME)
+        if heartbeat_interval is not None:
+            self.heartbeat_interval = heartbeat_interval
+        self.started = None
+        self._fh = None
+        self._stop_heartbeat = None
+        self._heartbeat_thread = None
+
+    def acquire(self, heartbeat_thread=True):
+        fh = os.fdopen(os.open(self.filename, os.O_RDWR | os.O_CREAT), "r+")
+        try:
+            fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            fh.close()
+            raise RunLockedError("%s is held by another process" % self.filename)
+        self._fh = fh
+        self.started = time.time()
+        self.refresh()
+
+        if heartbeat_thread:
+            self._stop_heartbeat = threading.Event()
+            self._heartbeat_thread = threading.Thread(target=self._heartbeat)
+            self._heartbeat_thread.daemon = True
+            self._heartbeat_thread.start()
+
+    def _heartbeat(self):
+        while not self._stop_heartbeat.wait(self.heartbeat_interval):
+            self.refresh()
+
+    def refresh(self):
+        fh = self._fh
+        if fh is None:
+            return
+        fh.seek(0)
+        fh.truncate()
+        fh.write("pid: %d\nhostname: %s\nstarted: %f\nheartbeat: %f\nheartbeat_interval: %f\n" % (
+                 os.getpid(), socket.gethostname(), self.started, time.time(), self.heartbeat_interval))
+        fh.flush()
+
+    def release(self):
+        if self._stop_heartbeat is not None:
+            self._stop_heartbeat.set()
+            self._heartbeat_thread.join()
+            self._stop_heartbeat = None
+        if self._fh is not None:
+            try:
+                os.remove(self.filename)
+            except OSError:
+                pass
+            fcntl.flock(self._fh, fcntl.LOCK_UN)
+            self._fh.close()
+            self._fh = None
+
+def readLockfile(filename):
+    """
+    Read the content of a lockfile into a dictionary. Lockfiles from before
+    heartbeats were introduced only contain the time the run started, which
+    is returned as its heartbeat.
+    """
+    fh = open(filename, "r")
+    content = fh.read()
+    fh.close()
+
+    lock_info = {}
+    for line in content.splitlines():
+        if ": " in line:
+            key, value = line.split(": ", 1)
+            lock_info[key] = value
+    try:
+        for key in ['pid']:
+            if key in lock_info:
+                lock_info[key] = int(lock_info[key])
+        for key in ['started', 'heartbeat', 'heartbeat_interval']:
+            if key in lock_info:
+                lock_info[key] = float(lock_info[key])
+    except ValueError:
+        lock_info = {}
+
+    if not 'heartbeat' in lock_info:
+        try:
+            started = time.mktime(time.strptime(content.strip().split(".")[0], "%Y-%m-%d %H:%M:%S"))
+            lock_info = { 'started': started, 'heartbeat': started }
+        except ValueError:
+            # being rewritten as we read it, the mtime is as good as the content
+            lock_info = { 'heartbeat': os.stat(filename).st_mtime }
+    return lock_info
+
+def _lockIsHeld(filename):
+    fh = open(filename, "r")
+    try:
+        fcntl.flock(fh, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        fcntl.flock(fh, fcntl.LOCK_UN)
+        return False
+    except IOError:
+        return True
+    finally:
+        fh.close()
+
+RUN_STATES = ('running', 'finished', 'stale', 'not_started')
+
+def classifyRunDirectory(output_directory, stale_after=None, hostname=None):
+    """
+    Work out whether the run in `output_directory` is running, finished,
+    stale (the run stopped without finishing, e.g. because it was killed) or
+    hasn't been started yet.
+
+    For runs on this host the `fcntl` lock decides if the run is alive, for
+    runs on other hosts the heartbeat must be no older than `stale_after`
+    seconds (by default three heartbeat intervals).
+    """
+    if hostname is None:
+        hostname = socket.gethostname()
+    filenames = os.listdir(output_directory)
+
+    if LOCKFILE_FILENAME in filenames:
+        lock_filename = os.path.join(output_directory, LOCKFILE_FILENAME)
+        try:
+            lock_info = readLockfile(lock_filename)
+            if lock_info.get('hostname') == hostname:
+                is_alive = _lockIsHeld(lock_filename)
+            else:
+                if stale_after is None:
+                    stale_after = 3*lock_info.get('heartbeat_interval', RunLock.heartbeat_interval)
+                is_alive = time.time() - lock_info['heartbeat'] < stale_after
+        except (IOError, OSError):
+            # the run finished and removed its lockfile while we looked
+            filenames = os.listdir(output_directory)
+        else:
+            if is_alive:
+                return 'running'
+            elif RUN_STATUS_FILENAME not in filenames:
+                # the run stopped without cleaning up, possibly only after it
+                # had finished (or the lockfile is from an older version)
+                if "run.log" in filenames and findRunDurationInLog(os.path.join(output_directory, "run.log")) is not None:
+                    return 'finished'
+                return 'stale'
+
+    if RUN_STATUS_FILENAME in filenames:
+        return 'finished'
+    elif "run.log" in filenames:
+        if findRunDurationInLog(os.path.join(output_directory, "run.log")) is not None:
+            return 'finished'
+        else:
+            return 'stale'
+    else:
+        return 'not_started'
+
+def scanRunDirectories(output_directories, stale_after=None):
+    """
+    Classify a number of run directories (see `classifyRunDirectory`),
+    returns a dictionary of lists of directories for each state.
+    """
+    hostname = socket.gethostname()
+    runs = dict([(state, []) for state in RUN_STATES])
+    for output_directory in output_directories:
+        try:
+            state = classifyRunDirectory(output_directory, stale_after=stale_after, hostname=hostname)
+        except OSError:
+            # directory removed since it was listed
+            continue
+        runs[state].append(output_directory)
+    return runs
+
+class TeeEngine(object):
+    """
+    Copies everything read from a number of pipes to a number of files.
+
+    All pipes are multiplexed in a single poll loop and read in large chunks as
+    soon as data is available, so that a child process is never left blocked on
+    a full pipe. Writes to the target files are batched and only happen (and are
+    flushed) every `flush_interval` seconds, or when more than `max_buffered`
+    bytes are waiting. Pipes are read until EOF and all buffered output is
+    written before `run` returns.
+    """
+    def __init__(self, flush_interval=0.2, chunk_size=65536, max_buffered=1048576):
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.max_buffered = max_buffered
+
+        self._sources = {}
+        self._buffers = []
+
+    def _getBuffer(self, target):
+        for buf in self._buffers:
+            if buf[0] is target:
+                return buf
+        buf = [target, [], 0]
+        self._buffers.append(buf)
+        return buf
+
+    def add(self, infile, *files):
+        """
+        Copy all output from `infile` to `files`.
+        """
+        self._sources[infile.fileno()] = (infile, [self._getBuffer(f) for f in files])
+
+    def flush(self):
+        for buf in self._buffers:
+            if buf[2] > 0:
+                buf[0].write("".join(buf[1]))
+                buf[0].flush()
+                buf[1] = []
+                buf[2] = 0
+
+    def _bufferedBytes(self):
+        return max([0] + [buf[2] for buf in self._buffers])
+
+    def _wait(self, poller, timeout):
+        if poller is not None:
+            if timeout is not None:
+                timeout = int(timeout*1000.0) + 1
+            return [fd for (fd, event) in poller.poll(timeout)]
+        else:
+            ready, _, _ = select.select(self._sources.keys(), [], [], timeout)
+            return ready
+
+    def _read(self, fd):
+        try:
+            return os.read(fd, self.chunk_size)
+        except OSError:
+            return ""
+
+    def run(self):
+        """
+        Copy output until all pipes have been closed.
+        """
+        poller = None
+        if hasattr(select, 'poll'):
+            poller = select.poll()
+            for fd in self._sources:
+                poller.register(fd, select.POLLIN | select.POLLPRI)
+
+        last_flush = time.time()
+        while len(self._sources) > 0:
+            if self._bufferedBytes() > 0:
+                timeout = max(0.0, last_flush + self.flush_interval - time.time())
+            else:
+                timeout = None
+
+            for fd in self._wait(poller, timeout):
+                infile, buffers = self._sources[fd]
+                data = self._read(fd)
+                if data == "":
+                    if poller is not None:
+                        poller.unregister(fd)
+                    infile.close()
+                    del self._sources[fd]
+                else:
+                    for buf in buffers:
+                        buf[1].append(data)
+                        buf[2] += len(data)
+
+            now = time.time()
+            if now - last_flush >= self.flush_interval or self._bufferedBytes() > self.max_buffered:
+                self.flush()
+                last_flush = now
+
+        self.flush()
 
 
 class TeedCall:
+    """
+    Run `cmd_args` and wait for it to complete, while copying the output of the
+    process to the files passed as `stdout` and `stderr` and to the terminal.
+    If a `monitor` (see `resource_usage.ResourceMonitor`) is given it is
+    started on the process and handed its final rusage.
+    """
     def __init__(self, cmd_args, **kwargs):
         stdout, stderr = [kwargs.pop(s, None) for s in 'stdout', 'stderr']
+        flush_interval = kwargs.pop('flush_interval', 0.2)
+        monitor = kwargs.pop('monitor', None)
         p = Popen(cmd_args,
                   stdout=PIPE if stdout is not None else None,
                   stderr=PIPE if stderr is not None else None,
                   **kwargs)
-        threads = []
         self.pid = p.pid
+        if monitor is not None:
+            monitor.start(p.pid)
+        engine = TeeEngine(flush_interval=flush_interval)
         if stdout is not None:
-            threads.append(tee(p.stdout, stdout, sys.stdout))
+            engine.add(p.stdout, stdout, sys.stdout)
         if stderr is not None:
-            threads.append(tee(p.stderr, stderr, sys.stderr))
-        for t in threads:
-            t.join()  # wait for IO completion
-        p.wait()
+            engine.add(p.stderr, stderr, sys.stderr)
+        engine.run()
+        rusage = resource_usage.waitWithRusage(p)
+        self.returncode = p.returncode
+        if monitor is not None:
+            monitor.finish(rusage)
 
     def communicate(self):
         return (None, None)
@@ -104,23 +637,105 @@ class TaskRun(object):
     This class contains all the logic required for keeping track of running
     a single task.
     """
-    def __init__(self, task, output_directory_base, fork_process=False, override_output_directory=None, num_repeats=0):
+    # how often output teed to the terminal is written to the logfile (in seconds)
+    log_flush_interval = 0.2
+    # how often the resource usage of the running task is sampled (in
+    # seconds), set to None to disable
+    resource_sampling_interval = 10.0
+
+    def __init__(self, task, output_directory_base, fork_process=False, override_output_directory=None, num_repeats=0, print_log=None,
+                 resume=False, force_rerun=False, content_hash=None):
+        """
+        With `resume` the task is continued in `override_output_directory`
+        instead of being started over: runs which completed already (out of
+        the `num_repeats` repeats) are skipped, the first run started is
+        continued from the latest checkpoint of the task (see
+        `BaseTask.findLatestCheckpoint`) and output is appended to the
+        existing `run.log`.
+
+        If an identical task (see `BaseTask.getContentHash`) has already
+        been run to completion in `output_directory_base` that run is reused
+        (`self.reused` is set and `self.output_directory` points to it) and
+        nothing is run, unless `force_rerun` is set.
+        """
         self.task = task
+        if resume and override_output_directory is None:
+            raise ValueError("The output directory of the run to resume must be given with `override_output_directory`")
 
+        # the hash must be calculated before the task is saved, as saving may
+        # change the settings
+        if content_hash is None:
+            content_hash = task.getContentHash()
+        self.content_hash = content_hash
+
+        self.reused = False
         if override_output_directory is not None:
             self.output_directory = override_output_directory
         else:
-            self.output_directory = BaseTask.getFreeOutputDirectory(output_directory_base=output_directory_base)
-            os.makedirs(self.output_directory)
-            task.save(self.output_directory)
+            completed_run = None
+            if not force_rerun:
+                completed_run = findCompletedRun(output_directory_base, content_hash)
+            if completed_run is not None:
+                print "Identical task already completed in %s, reusing it" % completed_run
+                self.output_directory = completed_run
+                self.reused = True
+            else:
+                self.output_directory = BaseTask.getFreeOutputDirectory(output_directory_base=output_directory_base)
+                task.save(self.output_directory)
 
-        self.print_log = not fork_process
+        if print_log is None:
+            print_log = not fork_process
+        self.print_log = print_log
 
         self.fork_process = fork_process
         self.num_repeats = num_repeats
         self.current_run = -1
+        self.task_process = None
+        self.run_lock = None
+        self.resource_monitor = None
+        # set when a child process writes to the logfile directly, in which
+        # case backspaces need stripping from the log afterwards
+        self.log_written_directly = False
+
+        self.resume = resume
+        self.completed_since = None
+        if resume:
+            progress = readRunProgress(self.output_directory)
+            if progress is not None:
+                self.current_run = progress['completed_runs'] - 1
+                self.completed_since = progress['updated']
+
+    def _allRunsCompleted(self):
+        return self.current_run >= self.num_repeats
+
+    def _recordRunFinished(self, returncode):
+        if returncode == 0:
+            writeRunProgress(self.output_directory, completed_runs=self.current_run + 1,
+                             num_repeats=self.num_repeats, updated=time.time())
+
+    def _findResumeCheckpoint(self):
+        # only the first run started can continue from a checkpoint, and only
+        # from one written since the last run completed
+        return self.task.findLatestCheckpoint(self.output_directory, newer_than=self.completed_since)
+
+    def _getExecutable(self):
+        if self.resume:
+            self.resume = False
+            checkpoint = self._findResumeCheckpoint()
+            if checkpoint is not None:
+                try:
+                    executable = self.task.get_resume_executable(outputdir=self.output_directory, checkpoint=checkpoint)
+                    print "Resuming from %s" % checkpoint
+                    return executable
+                except NotImplementedError as e:
+                    warnings.warn("%s, starting the run over" % str(e))
+        return self.task.get_executable(outputdir=self.output_directory)
 
     def __enter__(self):
+        if self.reused:
+            self.pid = None
+            return self
+
         child_pid = None
         if self.fork_process:
             forked_pid = os.fork()
@@ -129,13 +744,17 @@ class TaskRun(object):
 
         self._setupLogfile()
 
-        # setup lockfile
-        with open(os.path.join(self.output_directory, 'is_running.lock'), 'w') as fh:
-            import datetime
-            fh.write(str(datetime.datetime.now()))
-
         if not self.fork_process or child_pid is not None:
-            self.task_process = self.spawnProcess(logging_target=self.logging_target)
+            self.run_lock = RunLock(self.output_directory)
+            self.run_lock.acquire()
+            if self.resource_sampling_interval is not None:
+                self.resource_monitor = resource_usage.ResourceMonitor(self.output_directory, interval=self.resource_sampling_interval)
+            if self._allRunsCompleted():
+                print "All runs in %s have already completed" % self.output_directory
+                self.logfile.close()
+                self.run_lock.release()
+            else:
+                self.task_process = self.spawnProcess(logging_target=self.logging_target)
 
         try:
             self.pid = self.task_process.pid
@@ -156,20 +775,30 @@ class TaskRun(object):
 
     def __del__(self):
         # delete the lockfile
-        if os.path.exists(os.path.join(self.output_directory, 'is_running.lock')):
-            os.remove(os.path.join(self.output_directory, 'is_running.lock'))
+        if self.run_lock is not None:
+            self.run_lock.release()
 
     def spawnProcess(self, logging_target):
         self.current_run += 1
 
-        executable = self.task.get_executable(outputdir=self.output_directory)
+        executable = self._getExecutable()
 
         os.chdir(self.output_directory)
         args = executable
         if self.print_log:
-            return TeedCall(args, stdout=self.logfile, stderr=self.logfile)
+            process = TeedCall(args, stdout=logging_target, stderr=logging_target, flush_interval=self.log_flush_interval,
+                               monitor=self.resource_monitor)
+            self._recordRunFinished(process.returncode)
+            return process
         else:
-            return subprocess.Popen(args,bufsize=-1, stdout=logging_target,stderr=logging_target,stdin=subprocess.PIPE)
+            self.log_written_directly = True
+            process = subprocess.Popen(args,bufsize=-1, stdout=logging_target,stderr=logging_target,stdin=subprocess.PIPE)
+            self._startResourceMonitor(process)
+            return process
+
+    def _startResourceMonitor(self, process):
+        if self.resource_monitor is not None:
+            self.resource_monitor.start(process.pid)
 
     def kill(self):
         self.__exit__(None, None, None)
@@ -180,25 +809,37 @@ class TaskRun(object):
                 self.task_process.kill()
             except (OSError, AttributeError):
                 pass
+            if isinstance(self.task_process, subprocess.Popen):
+                # reap the process (if `communicate` wasn't called)
+                self.communicate()
 
         if self.pid is not None:
             if self.current_run < self.num_repeats:
                 self.task_process = self.spawnProcess(logging_target=self.logging_target)
-                self.task_process.communicate()
+                self.communicate()
 
                 return self.__exit__(typ, val, traceback)
 
             self.logfile.close()
-            # clean up the log file (remove backspace characters)
-            logfile = open(self.log_filename)
-            logfile_content_old = logfile.readlines()
-            logfile.close()
-
-            logfile = open(self.log_filename,"w+")
-            for line in logfile_content_old:
-                line = line.replace("\010","")
-                logfile.write(line)
-            logfile.close()
+            # clean up the log file (remove backspace characters), output that
+            # went through `self.logging_target` has been cleaned already
+            if self.log_written_directly:
+                stripBackspaces(self.log_filename)
+            if len(getattr(self.task, 'log_patterns', [])) > 0:
+                log_parsing.updateLogTimeseries(self.output_directory, self.task.log_patterns)
+
+            run_duration = findRunDurationInLog(self.log_filename)
+            writeRunStatus(self.output_directory,
+                           complete=run_duration is not None,
+                           run_duration=run_duration,
+                           returncode=getattr(self.task_process, 'returncode', None),
+                           num_runs=self.current_run + 1,
+                           finished=time.strftime("%Y-%m-%d %H:%M:%S"),
+                           content_hash=self.content_hash,
+                           )
+            if run_duration is not None:
+                registerCompletedRun(self.output_directory, self.content_hash)
+            self.run_lock.release()
 
             try:
                 import pynotify
@@ -216,20 +857,77 @@ class TaskRun(object):
         self.logging_target = LogEmitter(self.logfile)
 
     def communicate(self):
-        return self.task_process.communicate()[1]
+        if self.task_process is None:
+            return None
+        elif isinstance(self.task_process, subprocess.Popen):
+            if self.task_process.returncode is not None:
+                return None
+            # wait ourselves rather than through `Popen.communicate` so that the
+            # rusage of the process can be recorded
+            if self.task_process.stdin is not None and not self.task_process.stdin.closed:
+                self.task_process.stdin.close()
+            rusage = resource_usage.waitWithRusage(self.task_process)
+            if self.resource_monitor is not None and self.resource_monitor.pid is not None:
+                self.resource_monitor.finish(rusage)
+            self._recordRunFinished(self.task_process.returncode)
+            return None
+        else:
+            return self.task_process.communicate()[1]
 
 
 class ForkedTaskRun(TaskRun):
     pass
 
 class RunfileBasedTaskRun(TaskRun):
+    """
+    Runs the runscript saved with the task (see `BaseTask.save`). With
+    `profile` (taken from the task's `profile` unless given) set to
+    'deterministic' or 'sampling' the runscript is run under the profiler (see
+    `profiling`), each run writing `profile_<n>.prof` and a summary of the
+    hot functions, `profile_<n>_summary.txt`, to the output directory.
+    """
+    # how often the stack is sampled when profiling with 'sampling' (in
+    # seconds of CPU time)
+    profile_sampling_interval = 0.005
+
+    def __init__(self, task, output_directory_base, profile=None, **kwargs):
+        if profile is None:
+            profile = task.profile
+        if profile is not None and profile not in profiling.PROFILE_MODES:
+            raise ValueError("Profiling mode must be one of %s" % ", ".join(profiling.PROFILE_MODES))
+        self.profile = profile
+        if profile is not None:
+            # an earlier run of the same task won't have been profiled
+            kwargs.setdefault('force_rerun', True)
+        super(RunfileBasedTaskRun, self).__init__(task, output_directory_base, **kwargs)
+        if self.resume:
+            # the runscript is always run from the start, completed repeats
+            # are still skipped but a checkpoint can't be continued from
+            self.resume = False
+            checkpoint = self._findResumeCheckpoint()
+            if checkpoint is not None:
+                raise ValueError("Runs of runscripts can't be resumed from a checkpoint (%s), "
+                                 "remove it to run the task over" % checkpoint)
+
+    def getProfileFilename(self, run=None):
+        if run is None:
+            run = self.current_run
+        return os.path.join(self.output_directory, "profile_%d.prof" % run)
 
     def spawnProcess(self, logging_target):
         saved_generator_filename = self.task.getGeneratorSaveFilename(self.output_directory)
 
+        self.current_run += 1
         args = ['/usr/bin/python', saved_generator_filename]
+        if self.profile is not None:
+            args = profiling.getProfileCommand(python=args[0], mode=self.profile, script=saved_generator_filename,
+                                               profile_filename=self.getProfileFilename(),
+                                               interval=self.profile_sampling_interval)
         print " ".join(args)
-        return subprocess.Popen(args,stdout=logging_target,stderr=logging_target,stdin=subprocess.PIPE)
+        self.log_written_directly = True
+        process = subprocess.Popen(args,stdout=logging_target,stderr=logging_target,stdin=subprocess.PIPE)
+        self._startResourceMonitor(process)
+        return process
 
     def _writeRunfiles(self):
         # write the run files (these get written to the "runfiles" folder), and set the correct filename in the settings
@@ -250,7 +948,38 @@ class RunfileBasedTaskRun(TaskRun):
                 # TODO: If I start using runfiles again I should try and find out why the line below was needed
                 warnings.warn("Storing of runfiles in settings is currently not working correctly")
 
+_file_hashes = {}
+
+def _hashFileContent(filename):
+    """
+    SHA-1 of the content of `filename`, remembered for as long as the file's
+    mtime and size don't change (executables can be large).
+    """
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_mtime, stat.st_size)
+    if key not in _file_hashes:
+        file_hash = hashlib.sha1()
+        fh = open(filename, "rb")
+        for chunk in iter(lambda: fh.read(1048576), ""):
+            file_hash.update(chunk)
+        fh.close()
+        _file_hashes[key] = file_hash.hexdigest()
+    return _file_hashes[key]
+
 class BaseTask(object):
+    # glob patterns (relative to the output directory) of the checkpoint files
+    # a task's solver writes, used when resuming interrupted runs
+    checkpoint_patterns = []
+    # timeseries to extract from the solver's output, see `log_parsing`
+    log_patterns = []
+    # profiler to run the runscript under, see `RunfileBasedTaskRun`
+    profile = None
+    # attributes which describe where and by whom a task is run rather than
+    # what it computes, these are left out of the content hash
+    content_hash_ignored_attributes = ('owner', 'description', 'task_name', 'alreadyRun', 'taskfile', 'initDone',
+                                       'allow_output_overwrite', 'output_directory', 'output_directory_base',
+                                       'parent_directory', 'exit_on_complete')
+
     def __init__(self, generator, description, output_directory = None, output_directory_base = None, task_name = None, runfiles = [], owner = None, auto_run = False, exit_on_complete = False):
         if owner is None:
             owner = getpass.getuser()
@@ -287,16 +1016,76 @@ class BaseTask(object):
 
     @staticmethod
     def getFreeOutputDirectory(output_directory_base):
-        # find free output directory
-        n = 0
-        output_dir = os.path.join(output_directory_base, "task_%s/" % (time.strftime("%Y%m%d_%H%M%S")))
-        while True:
-            if os.path.exists(output_dir):
-                output_dir = os.path.join(output_directory_base, "task_%s_%i/" % (time.strftime("%Y%m%d_%H%M%S"), n))
-                n += 1
-            else:
-                break
-        return output_dir
+        return getFreeOutputDirectory(output_directory_base)
+
+    def findLatestCheckpoint(self, output_directory, newer_than=None):
+        """
+        Return the most recently written of the files in `output_directory`
+        matching `checkpoint_patterns`, optionally only considering files
+        modified after `newer_than` (seconds since the epoch). Returns None if
+        there are no checkpoints.
+        """
+        checkpoints = []
+        for pattern in self.checkpoint_patterns:
+            for filename in glob.glob(os.path.join(output_directory, pattern)):
+                mtime = os.path.getmtime(filename)
+                if newer_than is None or mtime > newer_than:
+                    checkpoints.append((mtime, filename))
+        if len(checkpoints) == 0:
+            return None
+        return max(checkpoints)[1]
+
+    def get_resume_executable(self, outputdir, checkpoint):
+        """
+        Return the command which continues the run in `outputdir` from
+        `checkpoint`, task types which support this need to implement it.
+        """
+        raise NotImplementedError("%s doesn't support resuming from a checkpoint" % self.__class__.__name__)
+
+    def getContentHash(self):
+        """
+        Return a hash of everything which determines the result of running
+        this task: its class, the generator, the runfiles, the settings, the
+        executable (including the content of the executable file itself) and
+        all other attributes apart from `content_hash_ignored_attributes`.
+        Two tasks with the same hash will compute the same thing.
+        """
+        content_hash = hashlib.sha1()
+        def add(text):
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            content_hash.update(str(len(text)))
+            content_hash.update(text)
+
+        add("%s.%s" % (self.__class__.__module__, self.__class__.__name__))
+        add(self.generator)
+        for runfile in self.runfiles:
+            add(runfile.name)
+            add(runfile.content)
+
+        settings = getattr(self, 'settings', None)
+        if settings is not None:
+            # arrays are only hashed, rather than dumped in full, and the
+            # pure Python dumper is used so that hashes are the same whether
+            # LibYAML is installed or not
+            with yaml_serialize.sidecarArrays(None):
+                add(yaml.dump(settings))
+
+        # e.g. the command a subclass builds its executable from
+        state = dict([(name, value) for (name, value) in self.__dict__.items()
+                      if name not in self.content_hash_ignored_attributes and name not in ('generator', 'runfiles', 'settings')])
+        with yaml_serialize.sidecarArrays(None):
+            add(yaml.dump(state))
+
+        executable = getattr(self, 'executable', None)
+        if isinstance(executable, basestring):
+            executable = [executable]
+        for part in executable or []:
+            add(str(part))
+            if isinstance(part, basestring) and os.path.isfile(part):
+                add(_hashFileContent(part))
+
+        return content_hash.hexdigest()
 
     def getGeneratorSaveFilename(self, output_directory):
         return os.path.join(output_directory, 'runscript.py')
@@ -311,11 +1100,16 @@ class BaseTask(object):
         f.write(self.generator)
         f.close()
 
-    def enqueue(self, host = None):
+    def enqueue(self, host = None, priority = 0):
         """
-        try and enqueue this task on the taskerServer requested.
+        try and enqueue this task on the taskerServer requested, or in the
+        local task queue (see `task_queue`) if lsc_tasker isn't available.
         """
-        lsc_tasker.utils.sendTask(self, host)
+        if HAS_LSC_TASKER:
+            lsc_tasker.utils.sendTask(self, host)
+        else:
+            import task_queue
+            task_queue.sendTask(self, host, priority=priority)
 
     def run(self, output_directory = None):
         if output_directory is None:
@@ -323,9 +1117,9 @@ class BaseTask(object):
                 output_directory_base = self.output_directory_base
                 if self.task_name is not None:
                     output_directory = os.path.join(output_directory_base, self.task_name)
+                    os.makedirs(output_directory)
                 else:
                     output_directory = self.getFreeOutputDirectory(output_directory_base=output_directory_base)
-                os.makedirs(output_directory)
             else:
                 output_directory = None
 
@@ -349,23 +1143,31 @@ class BaseTask(object):
         return self.getRunDuration() is not None
 
     def getRunDuration(self):
-        try:
-            logfile = open(os.path.join(self.settings.Output.directory,"run.log"),"r")
-            runDuration = None
-            for line in logfile.readlines():
-                if "Total time" in line:
-                    runDuration = float(line.split()[3][:-1])
-                    break
-            if not runDuration:
-                print "Task is still running (or was killed before completion)"
-            return runDuration
-        except IOError:
-            print "Task hasn't been started yet"
-            return None
+        output_directory = self.settings.Output.directory
+        run_status = readRunStatus(output_directory)
+
+        if run_status is None:
+            # run from before status files were written, look in the log
+            try:
+                runDuration = findRunDurationInLog(os.path.join(output_directory, "run.log"))
+            except IOError:
+                print "Task hasn't been started yet"
+                return None
+            if runDuration is not None:
+                try:
+                    writeRunStatus(output_directory, complete=True, run_duration=runDuration)
+                except IOError:
+                    pass
+        else:
+            runDuration = run_status.get('run_duration')
+
+        if not runDuration:
+            print "Task is still running (or was killed before completion)"
+        return runDuration
 
     def getLog(self):
         try:
-            logfile = open(os.path.join(self.settings.Output.directory,"run.log"),"r")
+            logfile = openRunFile(os.path.join(self.settings.Output.directory,"run.log"))
             log_content = logfile.readlines()
             logfile.close()
             return log_content
@@ -373,36 +1175,399 @@ class BaseTask(object):
             print "Task hasn't been started yet"
             return None
 
+    def getLogTimeseries(self, name):
+        """
+        The timeseries `name` (see `log_patterns`) extracted from the log,
+        bringing it up to date with the log first.
+        """
+        patterns = [pattern for pattern in self.log_patterns if pattern.name == name]
+        if len(patterns) == 0:
+            raise KeyError("There is no log pattern called %s" % name)
+        output_directory = self.settings.Output.directory
+        log_parsing.updateLogTimeseries(output_directory, self.log_patterns)
+        return log_parsing.loadLogTimeseries(output_directory, name, dtype=patterns[0].dtype)
+
     #def initTaskRun(self, output_directory_base):
         #pass
 
+def coresRequired(task, max_cores=None):
+    """
+    The number of cores `task` occupies while running: its `num_processes`
+    (1 if not set), but at most `max_cores`, as a task that needs more than the
+    whole machine simply gets it to itself.
+    """
+    num_processes = getattr(task, 'num_processes', None)
+    if not num_processes:
+        num_processes = 1
+    if max_cores is None:
+        return int(num_processes)
+    return min(int(num_processes), max_cores)
+
+class SubTaskFailedError(Exception):
+    pass
+
+def _runSubTask(sub_task):
+    """
+    Target of the worker processes started by `CompoundTask`, exits with a
+    non-zero code if the sub-task raised or its run didn't complete.
+    """
+    sub_task.run()
+    output_directory = getattr(sub_task, 'output_directory', None)
+    if output_directory is not None:
+        run_status = readRunStatus(output_directory)
+        if run_status is not None and not run_status.get('complete'):
+            sys.exit(1)
+
 class CompoundTask(BaseTask):
+    """
+    A task made up of other tasks, e.g. preprocessing, a set of simulations
+    and postprocessing of a study. `dependencies` maps a sub-task to the
+    sub-tasks which must have completed before it can start (either may be
+    given as the sub-task or its index in `sub_tasks`).
+
+    Sub-tasks are run in worker processes, as many at a time as their
+    dependencies and `max_cores` (all cores by default) allow. When a sub-task
+    fails all sub-tasks depending on it (directly or not) are skipped, the
+    others carry on, after which `SubTaskFailedError` is raised. Sub-tasks
+    without an output base of their own are stored in the compound task's
+    output directory.
+    """
+    # how often the state of running sub-tasks is checked (in seconds)
+    poll_interval = 0.5
+
     def __init__(self, sub_tasks, generator, description, output_directory_base,
                  task_name = None, runfiles = [], owner = None, auto_run = False,
-                 exit_on_complete = False):
+                 exit_on_complete = False, dependencies = None, max_cores = None):
 
         self.sub_tasks = sub_tasks
+        self.max_cores = max_cores
+
+        # stored by index so that the task can be saved and loaded
+        self.dependencies = [[] for t in sub_tasks]
+        for sub_task, required in (dependencies or {}).items():
+            self.dependencies[self._subTaskIndex(sub_task)] = sorted(set([self._subTaskIndex(t) for t in required]))
+        self._checkForCycles()
+
+        super(CompoundTask, self).__init__(generator=generator, description=description,
+                                           output_directory_base=output_directory_base, task_name=task_name,
+                                           runfiles=runfiles, owner=owner, auto_run=auto_run,
+                                           exit_on_complete=exit_on_complete)
+
+    def _subTaskIndex(self, sub_task):
+        if isinstance(sub_task, int):
+            if not 0 <= sub_task < len(self.sub_tasks):
+                raise ValueError("There is no sub-task with index %d" % sub_task)
+            return sub_task
+        for n, t in enumerate(self.sub_tasks):
+            if t is sub_task:
+                return n
+        raise ValueError("%s is not a sub-task of this task" % repr(sub_task))
+
+    def _checkForCycles(self):
+        visited = set()
+        def visit(n, path):
+            if n in path:
+                raise ValueError("The dependencies of sub-task %d are circular" % n)
+            if n not in visited:
+                for m in self.dependencies[n]:
+                    visit(m, path + [n])
+                visited.add(n)
+        for n in range(len(self.sub_tasks)):
+            visit(n, [])
 
     def _run(self, output_directory):
+        max_cores = self.max_cores
+        if max_cores is None:
+            max_cores = multiprocessing.cpu_count()
+
         for t in self.sub_tasks:
-            t.run()
+            if getattr(t, 'output_directory_base', None) is None and output_directory is not None:
+                t.output_directory_base = output_directory
+
+        # the state of each sub-task is one of 'pending', 'running',
+        # 'complete', 'failed' and 'skipped'
+        self.sub_task_states = ['pending' for t in self.sub_tasks]
+        states = self.sub_task_states
+        running = []
+        cores_free = max_cores
+
+        try:
+            self._runSubTasks(states, running, cores_free, max_cores)
+        except:
+            for n, process, cores in running:
+                process.terminate()
+                process.join()
+            raise
+
+        failed = [self.sub_tasks[n] for n in range(len(states)) if states[n] == 'failed']
+        if len(failed) > 0:
+            raise SubTaskFailedError("%d of %d sub-tasks failed (%d skipped): %s" % (len(failed), len(states), states.count('skipped'),
+                                                                                    ", ".join([str(t.description) for t in failed])))
+
+    def _runSubTasks(self, states, running, cores_free, max_cores):
+        while 'pending' in states or len(running) > 0:
+            for n, t in enumerate(self.sub_tasks):
+                if states[n] != 'pending':
+                    continue
+                required_states = [states[m] for m in self.dependencies[n]]
+                if 'failed' in required_states or 'skipped' in required_states:
+                    states[n] = 'skipped'
+                    print "Skipping %s, a sub-task it depends on failed" % str(t.description)
+                    continue
+                if any([state != 'complete' for state in required_states]):
+                    continue
+
+                cores = coresRequired(t, max_cores)
+                if cores > cores_free:
+                    continue
+                process = multiprocessing.Process(target=_runSubTask, args=(t,))
+                process.start()
+                states[n] = 'running'
+                running.append((n, process, cores))
+                cores_free -= cores
+
+            finished = [item for item in running if not item[1].is_alive()]
+            for item in finished:
+                n, process, cores = item
+                process.join()
+                running.remove(item)
+                cores_free += cores
+                if process.exitcode == 0:
+                    states[n] = 'complete'
+                else:
+                    states[n] = 'failed'
+                    print "Sub-task %s failed (exit code %s)" % (str(self.sub_tasks[n].description), process.exitcode)
+
+            if len(finished) == 0 and len(running) > 0:
+                time.sleep(self.poll_interval)
+
+def resumeTaskRun(output_directory, num_repeats=None, print_log=None):
+    """
+    Resume the (interrupted) run of the task stored in `output_directory`,
+    see `TaskRun`. Unless given, `num_repeats` is taken from the run's
+    progress file.
+    """
+    task = loadTask(os.path.join(output_directory, 'taskfile.tsk'))
+    if num_repeats is None:
+        progress = readRunProgress(output_directory)
+        if progress is not None:
+            num_repeats = progress['num_repeats']
+        else:
+            num_repeats = 0
+
+    task_run = TaskRun(task, output_directory_base=None, override_output_directory=output_directory,
+                       num_repeats=num_repeats, print_log=print_log, resume=True)
+    with task_run:
+        task_run.communicate()
+    return task_run
+
+def _runTaskInOutputDirectory(task, output_directory, content_hash):
+    """
+    Run `task` to completion in an output directory which has already been
+    created (and where the task has been saved). Used as the target of the
+    worker processes started by `LocalSweepExecutor`.
+    """
+    task_run = TaskRun(task, output_directory_base=None, override_output_directory=output_directory, print_log=False,
+                       content_hash=content_hash)
+    with task_run:
+        task_run.communicate()
+
+def _taskExitcode(output_directory, worker_exitcode):
+    """
+    The exit code reported for the run in `output_directory` by a worker
+    process which exited with `worker_exitcode`: the task's own return code,
+    or 1 if it returned 0 but the run didn't complete.
+    """
+    if worker_exitcode != 0:
+        return worker_exitcode
+    run_status = readRunStatus(output_directory)
+    if run_status is None:
+        return 1
+    if run_status.get('returncode'):
+        return run_status['returncode']
+    if not run_status.get('complete'):
+        return 1
+    return 0
+
+class LocalSweepExecutor(object):
+    """
+    Runs a set of tasks on the local machine, each in its own worker process.
+    Tasks are started in the order they were submitted, but only as long as the
+    sum of `num_processes` of the running tasks stays within `max_cores`, so that
+    a node is kept busy without being oversubscribed.
+
+    Output directories are allocated (and the task saved there) when a task is
+    submitted, so that finished runs have exactly the same layout as a run
+    started through `TaskRun`.
+    """
+    def __init__(self, output_directory_base, max_cores=None, poll_interval=0.5, force_rerun=False):
+        if max_cores is None:
+            max_cores = multiprocessing.cpu_count()
+        self.output_directory_base = output_directory_base
+        self.max_cores = max_cores
+        self.poll_interval = poll_interval
+        self.force_rerun = force_rerun
+
+        self.output_directories = []
+        self.exitcodes = {}
+        self._pending = []
+        self._running = []
+
+    def submit(self, task, output_directory_base=None):
+        """
+        Queue `task`, returns its output directory (allocated in
+        `output_directory_base` if given, rather than the executor's).
+        Tasks identical to one which has already completed in the output
+        base aren't run again (unless `force_rerun` is set), the directory of
+        the completed run is returned instead.
+        """
+        if output_directory_base is None:
+            output_directory_base = self.output_directory_base
+        content_hash = task.getContentHash()
+        if not self.force_rerun:
+            completed_run = findCompletedRun(output_directory_base, content_hash)
+            if completed_run is not None:
+                print "Identical task already completed in %s, reusing it" % completed_run
+                self.output_directories.append(completed_run)
+                self.exitcodes[completed_run] = 0
+                return completed_run
+
+        output_directory = BaseTask.getFreeOutputDirectory(output_directory_base=output_directory_base)
+        task.save(output_directory)
+
+        self._pending.append((task, output_directory, content_hash))
+        self.output_directories.append(output_directory)
+        return output_directory
+
+    def _startPendingTasks(self, cores_free):
+        for item in list(self._pending):
+            task, output_directory, content_hash = item
+            cores = coresRequired(task, self.max_cores)
+            if cores > cores_free:
+                continue
+
+            process = multiprocessing.Process(target=_runTaskInOutputDirectory, args=(task, output_directory, content_hash))
+            process.start()
+            print "Started %s in %s (pid %d, %d cores)" % (str(task.description), output_directory, process.pid, cores)
+
+            self._pending.remove(item)
+            self._running.append((process, output_directory, cores))
+            cores_free -= cores
+
+    def _collectFinishedTasks(self):
+        for item in list(self._running):
+            process, output_directory, cores = item
+            if not process.is_alive():
+                process.join()
+                self._running.remove(item)
+                self.exitcodes[output_directory] = _taskExitcode(output_directory, process.exitcode)
+
+    def coresFree(self):
+        """
+        The number of cores not taken by running tasks.
+        """
+        return self.max_cores - sum([cores for (_, _, cores) in self._running])
+
+    def isBusy(self):
+        """
+        Whether any submitted tasks are still waiting or running.
+        """
+        return len(self._pending) > 0 or len(self._running) > 0
+
+    def step(self):
+        """
+        Collect the tasks which have finished and start as many pending tasks
+        as there are free cores for, without blocking. Returns a list of
+        `(output_directory, exitcode)` of the tasks which have finished since
+        the last call (in submission order), which are then forgotten by the
+        executor.
+        """
+        self._collectFinishedTasks()
+        self._startPendingTasks(self.coresFree())
+
+        finished = [(output_directory, self.exitcodes[output_directory]) for output_directory in self.output_directories
+                    if output_directory in self.exitcodes]
+        self.output_directories = [output_directory for output_directory in self.output_directories
+                                   if output_directory not in self.exitcodes]
+        self.exitcodes = {}
+        return finished
+
+    def abandon(self, terminate=False):
+        """
+        Drop the pending tasks and wait for the running ones to exit, killing
+        them first if `terminate` is set.
+        """
+        for process, _, _ in self._running:
+            if terminate:
+                process.terminate()
+            process.join()
+        self._running = []
+        self._pending = []
+
+    def run(self):
+        """
+        Run all submitted tasks, blocking until every one of them has finished.
+        Returns a list of `(output_directory, exitcode)` in submission order,
+        where the exit code is that of the task (see `_taskExitcode`). Tasks
+        already returned by `step` aren't included.
+        """
+        output_directories = list(self.output_directories)
+        exitcodes = {}
+        while True:
+            exitcodes.update(self.step())
+            if not self.isBusy():
+                break
+            time.sleep(self.poll_interval)
+
+        return [(output_directory, exitcodes.get(output_directory)) for output_directory in output_directories]
 
 class ParameterStudyHelper:
     """
     This class is intended for use when a parameter study is to be run. A full copy
     of the generator script (the script in which an instance of this class is created)
     will be included within the task definition, so that the task can be easily rerun.
+
+    Tasks are queued with `sendTask` and run locally with `run`, which will use
+    at most `max_cores` cores at a time (all available cores by default). Unless
+    `output_directory_base` is given, output is written next to the generator.
+    Tasks which have already been run to completion are only run again if
+    `force_rerun` is set.
     """
 
-    def __init__(self, generator_filename, base_settings, executable, num_processes, description, task_type):
+    def __init__(self, generator_filename, base_settings, executable, num_processes, description, task_type,
+                 output_directory_base=None, max_cores=None, force_rerun=False):
         self.generator_filename = generator_filename
         self.base_settings = base_settings
         self.executable = executable
         self.num_processes = num_processes
         self.description = description
+        self.task_type = task_type
+
+        if output_directory_base is None:
+            output_directory_base = os.path.dirname(os.path.abspath(generator_filename))
+        self.executor = LocalSweepExecutor(output_directory_base=output_directory_base, max_cores=max_cores, force_rerun=force_rerun)
+
+    def _makeTask(self, settings, runfiles):
+        fh = open(self.generator_filename)
+        generator = fh.read()
+        fh.close()
+
+        return self.task_type(owner=getpass.getuser(), num_processes=self.num_processes, executable=self.executable,
+                              settings=settings, description=self.description, generator=generator, runfiles=runfiles)
 
     def sendTask(self, settings, runfiles = []):
-        pass
+        """
+        Queue a task with the given settings, returns the output directory
+        allocated for it. Nothing is run until `run` is called.
+        """
+        task = self._makeTask(settings, runfiles)
+        return self.executor.submit(task)
+
+    def run(self):
+        """
+        Run all queued tasks, blocking until all of them have completed.
+        """
+        return self.executor.run()
 
 class SettingsGenerationHelper(object):
     def __init__(self, generator, task_description, settings, output_dir):
@@ -439,12 +1604,12 @@ class SettingsGenerationHelper(object):
         pycfd_basedir = common.basedir
         return pycfd_basedir
 
-    def enqueue(self, host = None):
+    def enqueue(self, host = None, priority = 0):
         """
         try and enqueue this task on the taskerServer requested.
         """
         task = self._makeTask()
-        lsc_tasker.utils.sendTask(task, host)
+        task.enqueue(host, priority=priority)
 
 class UnknownSettingsTypeError(Exception):
     pass
@@ -473,56 +1638,399 @@ class UnknownSettingsTypeError(Exception):
         #import py_lsc_amr
         #return py_lsc_amr.Settings.load(filename)
 
-def writeTask(task, filename):
+# the metadata of a task is repeated in comments at the top of its taskfile,
+# so that it can be read without parsing the rest (see `readTaskMetadata`)
+TASK_HEADER_START = "# task header"
+TASK_HEADER_END = "# end of task header"
+
+def _writeTaskHeader(task, taskfile):
+    header = {'task_type': "%s.%s" % (task.__class__.__module__, task.__class__.__name__)}
+    for field in TASK_METADATA_FIELDS:
+        value = getattr(task, field, None)
+        # anything else is left out, and read from the task itself
+        if value is None or isinstance(value, basestring):
+            header[field] = value
+    taskfile.write(TASK_HEADER_START + "\n")
+    for line in yaml.safe_dump(header, default_flow_style=False).splitlines():
+        taskfile.write("# " + line + "\n")
+    taskfile.write(TASK_HEADER_END + "\n")
+
+def _readTaskHeader(taskfile):
+    """
+    Read the header from the start of `taskfile`, returns None if there
+    isn't a (complete) header.
+    """
+    if taskfile.readline().rstrip("\n") != TASK_HEADER_START:
+        return None
+    lines = []
+    for line in taskfile:
+        line = line.rstrip("\n")
+        if line == TASK_HEADER_END:
+            break
+        if not line.startswith("# "):
+            return None
+        lines.append(line[2:])
+    else:
+        return None
+    try:
+        header = yaml.safe_load("\n".join(lines))
+    except yaml.YAMLError:
+        return None
+    if not isinstance(header, dict) or any([field not in header for field in TASK_METADATA_FIELDS]):
+        return None
+    return header
+
+def writeTask(task, filename, array_sidecars=True):
+    """
+    Store `task` as YAML in `filename`. Large arrays are written to `.npy`
+    files next to it (see `yaml_serialize`) unless `array_sidecars` is False,
+    in which case the file is self-contained.
+    """
     taskfile = open(filename, "wb")
-    yaml.dump(task, taskfile)
-    taskfile.close()
+    _writeTaskHeader(task, taskfile)
+    if array_sidecars:
+        with yaml_serialize.sidecarArrays(filename) as sidecars:
+            yaml_serialize.dump(task, taskfile)
+        taskfile.close()
+        sidecars.removeUnused()
+    else:
+        yaml_serialize.dump(task, taskfile)
+        taskfile.close()
+
+
+# loaded tasks are cached in a binary sidecar file next to the taskfile,
+# which is used instead of parsing the YAML for as long as it is up to date
+TASK_CACHE_ENABLED = True
+TASK_CACHE_SUFFIX = '.cache'
 
+_task_cache_errors = (cPickle.UnpicklingError, EOFError, ValueError, TypeError, AttributeError, ImportError, KeyError, IndexError)
 
-def loadTask(task_filename):
+def _readTaskCache(cache_filename, taskfile, stat):
+    """
+    Return the task stored in the cache file if it was made from the current
+    content of `taskfile`, otherwise None. If the taskfile had to be read to
+    check this its content is returned too.
+    """
+    try:
+        cache = open(cache_filename, "rb")
+    except IOError:
+        return None, None
+
+    content = None
+    try:
+        header = cPickle.load(cache)
+        if header['mtime'] != stat.st_mtime or header['size'] != stat.st_size:
+            # touched or copied, still fine if the content is unchanged
+            content = taskfile.read()
+            if header['sha1'] != hashlib.sha1(content).hexdigest():
+                return None, content
+        return cPickle.load(cache), content
+    except _task_cache_errors:
+        return None, content
+    finally:
+        cache.close()
+
+def _writeTaskCache(cache_filename, stat, content, task):
+    tmp_filename = "%s.%d.tmp" % (cache_filename, os.getpid())
+    try:
+        cache = open(tmp_filename, "wb")
+        try:
+            header = { 'mtime': stat.st_mtime, 'size': stat.st_size, 'sha1': hashlib.sha1(content).hexdigest() }
+            cPickle.dump(header, cache, cPickle.HIGHEST_PROTOCOL)
+            cPickle.dump(task, cache, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            cache.close()
+        os.rename(tmp_filename, cache_filename)
+    except (IOError, OSError, cPickle.PicklingError, TypeError):
+        # read-only location or an unpicklable task, just don't cache it
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+def _constructTask(taskfile, task_filename, use_cache):
+    with yaml_serialize.sidecarArrays(task_filename, open_file=openRunFile) as sidecars:
+        if not use_cache:
+            return yaml_serialize.load(taskfile.read())
+
+        stat = os.fstat(taskfile.fileno())
+        cache_filename = taskfile.name + TASK_CACHE_SUFFIX
+        task, content = _readTaskCache(cache_filename, taskfile, stat)
+        if task is None:
+            if content is None:
+                content = taskfile.read()
+            task = yaml_serialize.load(content)
+            # memory-mapped arrays would be copied into the cache, and the
+            # YAML referencing them is quick to load anyway
+            if sidecars.loaded == 0:
+                _writeTaskCache(cache_filename, stat, content, task)
+        return task
+
+class LazyTask(object):
+    """
+    Stands in for a stored task, see `loadTask`. The task's metadata (see
+    `readTaskMetadata`) is available straight away, and the task itself is
+    loaded from the taskfile when any other attribute is first accessed or
+    by calling `load`.
+    """
+    def __init__(self, task_filename, metadata, use_cache=None):
+        self._lazy_filename = task_filename
+        self._lazy_metadata = metadata
+        self._lazy_use_cache = use_cache
+        self._lazy_task = None
+
+    def load(self):
+        if self._lazy_task is None:
+            task = loadTask(self._lazy_filename, use_cache=self._lazy_use_cache)
+            if task is None:
+                raise IOError("Couldn't load the task in %s" % self._lazy_filename)
+            self._lazy_task = task
+        return self._lazy_task
+
+    def __getattr__(self, name):
+        # don't load the task for the attribute lookups of pickle and copy
+        if name.startswith('_lazy_') or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+        if self._lazy_task is None and name in self._lazy_metadata:
+            return self._lazy_metadata[name]
+        return getattr(self.load(), name)
+
+    def __setattr__(self, name, value):
+        if name.startswith('_lazy_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.load(), name, value)
+
+    def __repr__(self):
+        if self._lazy_task is not None:
+            return repr(self._lazy_task)
+        return "<LazyTask %s: %s>" % (self._lazy_metadata.get('task_type'), self._lazy_filename)
+
+def loadTask(task_filename, use_cache=None, lazy=False):
+    """
+    Load the task stored in `task_filename`. With `lazy` a `LazyTask` is
+    returned instead, which only reads the task's metadata until more is
+    needed.
+    """
+    if use_cache is None:
+        use_cache = TASK_CACHE_ENABLED
     taskfile = None
     if '*' in task_filename:
-        return findTaskFilesAndLoad(task_filename)
+        return findTaskFilesAndLoad(task_filename, lazy=lazy)
+    elif lazy:
+        try:
+            metadata = readTaskMetadata(task_filename)
+        except IOError:
+            print "Error: Couldn't find the task specified (%s)" % task_filename
+            return None
+        metadata['taskfile'] = task_filename
+        metadata['parent_directory'] = os.path.dirname(os.path.abspath(task_filename))
+        return LazyTask(task_filename, metadata, use_cache=use_cache)
     else:
         try:
-            taskfile = open(task_filename,"r")
+            taskfile = openRunFile(task_filename)
         except IOError:
             print "Error: Couldn't find the task specified, either pass in the full filename with path or write the task date and time.\ne.g. loadTask('20110516_091754')"
 
         if taskfile:
             try:
-                task = yaml.load(taskfile.read())
+                # there is no cache next to taskfiles in archived runs
+                task = _constructTask(taskfile, task_filename, use_cache=use_cache and isinstance(taskfile, file))
                 # Override the output-dir so that files associated with tasks may be accessed properly if the task has been moved
-                task.taskfile = taskfile.name
+                task.taskfile = task_filename
                 task.parent_directory = os.path.dirname(os.path.abspath(task_filename))
                 return task
             except EOFError:
                 print "There was a problem with loading %s, unexpected end of file." % task_filename
                 return None
+            finally:
+                taskfile.close()
             #except yaml.constructor.ConstructorError:
                 #print "The stored task object could not be recreated (%s)" % task_filename
         else:
             return None
 
+def benchmarkTaskCache(task_filename, repeats=10):
+    """
+    Compare how long it takes to load `task_filename` by parsing the YAML and
+    from the binary cache. Returns the average time per load for both.
+    """
+    t0 = time.time()
+    for n in range(repeats):
+        loadTask(task_filename, use_cache=False)
+    t_yaml = (time.time() - t0)/repeats
+
+    # make sure the cache is there before timing it
+    loadTask(task_filename, use_cache=True)
+    t0 = time.time()
+    for n in range(repeats):
+        loadTask(task_filename, use_cache=True)
+    t_cache = (time.time() - t0)/repeats
+
+    print "%s (%d bytes)" % (task_filename, os.path.getsize(task_filename))
+    print "YAML: %.2fms per load, cache: %.2fms per load (%.1fx faster)" % (t_yaml*1.0e3, t_cache*1.0e3, t_yaml/t_cache)
+    return t_yaml, t_cache
+
+
+TASK_METADATA_FIELDS = ('owner', 'description', 'task_name')
+
+def readTaskMetadata(task_filename):
+    """
+    Read the basic metadata of a stored task (owner, description, task name
+    and the name of the task class) without reconstructing the task object.
+    This is read from the header `writeTask` puts at the top of taskfiles.
+    For taskfiles without one only the YAML node graph is built, so none of
+    the modules defining the task or its settings need to be imported.
+    """
+    fh = openRunFile(task_filename)
+    try:
+        header = _readTaskHeader(fh)
+    finally:
+        fh.close()
+    if header is not None:
+        return header
+
+    fh = openRunFile(task_filename)
+    try:
+        root = yaml.compose(fh)
+    finally:
+        fh.close()
+
+    metadata = dict([(field, None) for field in TASK_METADATA_FIELDS])
+    metadata['task_type'] = None
+
+    if root is None:
+        return metadata
+
+    for tag_prefix in ['tag:yaml.org,2002:python/object:', 'tag:yaml.org,2002:python/object/new:']:
+        if root.tag.startswith(tag_prefix):
+            metadata['task_type'] = root.tag[len(tag_prefix):]
+
+    state = root
+    if isinstance(root, yaml.MappingNode) and root.tag.startswith('tag:yaml.org,2002:python/object/new:'):
+        # objects with `__getstate__`/`__reduce__` have their state nested
+        for key_node, value_node in root.value:
+            if key_node.value == 'state':
+                state = value_node
+
+    if isinstance(state, yaml.MappingNode):
+        for key_node, value_node in state.value:
+            if key_node.value in TASK_METADATA_FIELDS and isinstance(value_node, yaml.ScalarNode):
+                if value_node.tag != 'tag:yaml.org,2002:null':
+                    metadata[key_node.value] = value_node.value
+
+    return metadata
+
+
+_workpool = None
 
 def get_workpool():
-    return multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    """
+    Return the pool of worker processes used for loading tasks in parallel.
+    The pool is created the first time it is needed and then kept around,
+    rather than paying for starting up new workers on every call.
+    """
+    global _workpool
+    if _workpool is None:
+        _workpool = multiprocessing.Pool(processes=multiprocessing.cpu_count())
+    return _workpool
 
-def findTaskFilesAndLoad(path, recursive=False):
+def _imapBounded(function, iterable, max_in_flight):
+    """
+    Like `Pool.imap`, but with no more than `max_in_flight` items submitted
+    and not yet consumed, so that results never pile up in memory when they
+    are consumed more slowly than they are produced.
+    """
+    workpool = get_workpool()
+    in_flight = collections.deque()
+    for item in iterable:
+        in_flight.append(workpool.apply_async(function, (item,)))
+        if len(in_flight) >= max_in_flight:
+            yield in_flight.popleft().get()
+        # don't hold back results which are ready while the input is slow
+        while len(in_flight) > 0 and in_flight[0].ready():
+            yield in_flight.popleft().get()
+    while len(in_flight) > 0:
+        yield in_flight.popleft().get()
+
+def _readTaskMetadataOrNone(task_filename):
+    try:
+        return readTaskMetadata(task_filename)
+    except (IOError, yaml.YAMLError):
+        return None
+
+def findTaskFiles(path, recursive=False):
+    """
+    Find the taskfiles in `path` (or below it if `recursive`), sorted by
+    modification time. Taskfiles of archived runs are included, see
+    `task_archive`.
+    """
+    import task_archive
     matches = []
     if recursive:
         for root, dirnames, filenames in os.walk(path):
             for filename in fnmatch.filter(filenames, 'taskfile.tsk'):
                 matches.append(os.path.join(root, filename))
+            matches += task_archive.findArchivedTaskfiles(root, filenames)
     else:
         matches = glob.glob(os.path.join(path,"taskfile.tsk"))
+        if len(matches) == 0 and task_archive.isArchived(path):
+            matches = [os.path.join(path, "taskfile.tsk")]
 
-    taskfiles_list = [(os.stat(i).st_mtime, i) for i in matches]
+    taskfiles_list = [(task_archive.getModificationTime(i), i) for i in matches]
     taskfiles_list.sort()
-    taskfiles_list = [taskfile[1] for taskfile in taskfiles_list]
+    return [taskfile[1] for taskfile in taskfiles_list]
+
+def _loadTaskLazily(task_filename):
+    return loadTask(task_filename, lazy=True)
+
+def _readTaskfileMetadata(task_filename):
+    metadata = _readTaskMetadataOrNone(task_filename)
+    if metadata is not None:
+        metadata['taskfile'] = task_filename
+    return metadata
+
+def _filterTaskfiles(taskfiles, filter, max_in_flight):
+    """
+    Yield the taskfiles among `taskfiles` whose metadata `filter` accepts, as
+    soon as their metadata has been read, see `iterLoadTasks`.
+    """
+    for metadata in _imapBounded(_readTaskfileMetadata, taskfiles, max_in_flight):
+        if metadata is not None and filter(metadata):
+            yield metadata['taskfile']
+
+def iterLoadTasks(taskfiles, filter=None, max_in_flight=None, lazy=False):
+    """
+    Load the tasks in `taskfiles` in parallel, yielding each task (in order)
+    as soon as it is available. At most `max_in_flight` tasks (twice the
+    number of workers by default) are held in memory at a time. With `lazy`
+    `LazyTask`s are yielded, see `loadTask`.
+
+    If given, `filter` is called with the metadata of each task (see
+    `readTaskMetadata`, with the taskfile's path added as `taskfile`) and
+    only tasks for which it returns True are deserialised at all.
+    """
+    if max_in_flight is None:
+        max_in_flight = 2*multiprocessing.cpu_count()
+
+    if filter is not None:
+        taskfiles = _filterTaskfiles(taskfiles, filter, max_in_flight)
+
+    if lazy:
+        load = _loadTaskLazily
+    else:
+        load = loadTask
+    for task in _imapBounded(load, taskfiles, max_in_flight):
+        if task is not None:
+            yield task
+
+def iterTaskFilesAndLoad(path, recursive=False, filter=None, max_in_flight=None, lazy=False):
+    """
+    Generator version of `findTaskFilesAndLoad`, see `iterLoadTasks`.
+    """
+    return iterLoadTasks(findTaskFiles(path, recursive=recursive), filter=filter, max_in_flight=max_in_flight, lazy=lazy)
+
+def findTaskFilesAndLoad(path, recursive=False, lazy=False):
+    taskfiles_list = findTaskFiles(path, recursive=recursive)
     print "Loading %d tasks..." % len(taskfiles_list)
-    workpool = get_workpool()
-    tasks = workpool.map(loadTask, taskfiles_list)
-    tasks = [task for task in tasks if task is not None]
+    tasks = list(iterLoadTasks(taskfiles_list, lazy=lazy))
     print "%d tasks loaded." % len(tasks)
     return tasks
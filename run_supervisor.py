@@ -0,0 +1,290 @@
+"""
+Supervision of many concurrent task runs from a single process.
+
+A `RunSupervisor` starts the executables of a number of tasks as child
+processes and watches all of them from one event loop built on `poll`: the
+output of every run is streamed into its own `run.log`, lockfiles are held
+(and their heartbeats refreshed) while runs are going, and runs with `num_repeats` are
+restarted as many times as requested. The resource usage of each run is
+sampled as well (see `resource_usage`), and timeseries are extracted from
+the logs as they grow (see `log_parsing`). No threads or forked copies of the
+calling process are involved, so hundreds of runs can be watched at once.
+
+At most `max_concurrent` runs are active at the same time, further runs wait
+in a queue of at most `max_pending` entries. Once that queue is full
+`submit` keeps the event loop going until there is room again, so a script
+generating a large sweep can't get ahead of the runs. For example::
+
+    supervisor = RunSupervisor(output_directory_base='/data/runs', max_concurrent=32)
+    for settings in settings_variants:
+        supervisor.submit(Task(settings=settings, ...))
+    supervisor.run()
+"""
+
+import os
+import time
+import select
+import subprocess
+
+import run_handling
+import resource_usage
+import log_parsing
+
+class SupervisedRun(object):
+    """
+    State of a single task run managed by a `RunSupervisor`.
+    """
+    def __init__(self, task, output_directory, num_repeats, content_hash, resource_sampling_interval=None):
+        self.task = task
+        self.output_directory = output_directory
+        self.num_repeats = num_repeats
+        self.content_hash = content_hash
+        self.current_run = -1
+
+        self.resource_monitor = None
+        if resource_sampling_interval is not None:
+            # sampled from the supervisor's event loop rather than a thread per run
+            self.resource_monitor = resource_usage.ResourceMonitor(output_directory, interval=resource_sampling_interval,
+                                                                   sampling_thread=False)
+
+        self.process = None
+        self.pipe_open = False
+        self.returncode = None
+        self.logfile = None
+        self.logging_target = None
+        self.run_lock = None
+
+    @property
+    def log_filename(self):
+        return os.path.join(self.output_directory, "run.log")
+
+    def start(self):
+        try:
+            if self.logfile is None:
+                self.logfile = open(self.log_filename, "a")
+                self.logging_target = run_handling.LogEmitter(self.logfile)
+
+                # the supervisor refreshes the heartbeats of all its runs itself
+                self.run_lock = run_handling.RunLock(self.output_directory)
+                self.run_lock.acquire(heartbeat_thread=False)
+
+            self.current_run += 1
+            args = self.task.get_executable(outputdir=self.output_directory)
+            devnull = open(os.devnull)
+            try:
+                self.process = subprocess.Popen(args, cwd=self.output_directory,
+                                                stdin=devnull, stdout=subprocess.PIPE,
+                                                stderr=subprocess.STDOUT, close_fds=True)
+            finally:
+                devnull.close()
+        except:
+            self._abandon()
+            raise
+        self.pipe_open = True
+        if self.resource_monitor is not None:
+            self.resource_monitor.start(self.process.pid)
+
+    def _abandon(self):
+        # the run couldn't be started, leave it as it was
+        if self.run_lock is not None:
+            self.run_lock.release()
+            self.run_lock = None
+        if self.logfile is not None:
+            self.logfile.close()
+            self.logfile = None
+
+    def poll(self):
+        """
+        Check if the current process has exited, recording its rusage if so.
+        """
+        returncode, rusage = resource_usage.pollWithRusage(self.process)
+        if returncode is not None:
+            self.returncode = returncode
+            if self.resource_monitor is not None and self.resource_monitor.pid is not None:
+                self.resource_monitor.finish(rusage)
+        return returncode
+
+    def hasRepeatsLeft(self):
+        return self.current_run < self.num_repeats
+
+    def updateLogTimeseries(self):
+        if len(getattr(self.task, 'log_patterns', [])) > 0:
+            log_parsing.updateLogTimeseries(self.output_directory, self.task.log_patterns)
+
+    def finish(self):
+        self.logfile.close()
+        self.updateLogTimeseries()
+
+        run_duration = run_handling.findRunDurationInLog(self.log_filename)
+        run_handling.writeRunStatus(self.output_directory,
+                                    complete=run_duration is not None,
+                                    run_duration=run_duration,
+                                    returncode=self.returncode,
+                                    num_runs=self.current_run + 1,
+                                    finished=time.strftime("%Y-%m-%d %H:%M:%S"),
+                                    content_hash=self.content_hash,
+                                    )
+        if run_duration is not None:
+            run_handling.registerCompletedRun(self.output_directory, self.content_hash)
+        self.run_lock.release()
+
+    def kill(self):
+        if self.process is not None and self.process.returncode is None:
+            try:
+                self.process.kill()
+            except OSError:
+                pass
+            rusage = resource_usage.waitWithRusage(self.process)
+            if self.resource_monitor is not None:
+                self.resource_monitor.finish(rusage)
+        self.returncode = self.process.returncode
+
+class RunSupervisor(object):
+    def __init__(self, output_directory_base, max_concurrent=64, max_pending=256,
+                 flush_interval=1.0, chunk_size=65536, resource_sampling_interval=10.0, log_parsing_interval=30.0):
+        self.output_directory_base = output_directory_base
+        self.max_concurrent = max_concurrent
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.chunk_size = chunk_size
+        self.resource_sampling_interval = resource_sampling_interval
+        self.log_parsing_interval = log_parsing_interval
+
+        self.pending = []
+        self.active = []
+        self.finished = []
+
+        self._pipes = {}
+        self._poller = select.poll()
+        self._last_flush = time.time()
+        self._last_heartbeat = time.time()
+        self._last_log_parsing = time.time()
+
+    def submit(self, task, num_repeats=0, output_directory=None, force_rerun=False):
+        """
+        Queue `task` for running, the output directory is allocated (and the
+        task saved there) straight away and returned. Blocks while the queue
+        of pending runs is full. If an identical task has already completed
+        in the output base its directory is returned and nothing is run,
+        unless `force_rerun` is set.
+        """
+        content_hash = task.getContentHash()
+        if output_directory is None:
+            if not force_rerun:
+                completed_run = run_handling.findCompletedRun(self.output_directory_base, content_hash)
+                if completed_run is not None:
+                    return completed_run
+            output_directory = run_handling.BaseTask.getFreeOutputDirectory(output_directory_base=self.output_directory_base)
+            task.save(output_directory)
+
+        while len(self.pending) >= self.max_pending:
+            self.step()
+
+        self.pending.append(SupervisedRun(task=task, output_directory=output_directory, num_repeats=num_repeats,
+                                          content_hash=content_hash,
+                                          resource_sampling_interval=self.resource_sampling_interval))
+        self._startPending()
+        return output_directory
+
+    def _startRun(self, supervised_run):
+        supervised_run.start()
+        fd = supervised_run.process.stdout.fileno()
+        self._pipes[fd] = supervised_run
+        self._poller.register(fd, select.POLLIN | select.POLLPRI)
+
+    def _startPending(self):
+        while len(self.pending) > 0 and len(self.active) < self.max_concurrent:
+            supervised_run = self.pending.pop(0)
+            self._startRun(supervised_run)
+            self.active.append(supervised_run)
+
+    def _closePipe(self, fd):
+        supervised_run = self._pipes.pop(fd)
+        self._poller.unregister(fd)
+        supervised_run.process.stdout.close()
+        supervised_run.pipe_open = False
+
+    def _readOutput(self, timeout):
+        for fd, event in self._poller.poll(timeout):
+            try:
+                data = os.read(fd, self.chunk_size)
+            except OSError:
+                data = ""
+
+            if data == "":
+                self._closePipe(fd)
+            else:
+                self._pipes[fd].logging_target.write(data)
+
+        now = time.time()
+        if now - self._last_flush >= self.flush_interval:
+            for supervised_run in self.active:
+                supervised_run.logfile.flush()
+            self._last_flush = now
+        if now - self._last_heartbeat >= run_handling.RunLock.heartbeat_interval:
+            for supervised_run in self.active:
+                supervised_run.run_lock.refresh()
+            self._last_heartbeat = now
+        if now - self._last_log_parsing >= self.log_parsing_interval:
+            for supervised_run in self.active:
+                supervised_run.logfile.flush()
+                supervised_run.updateLogTimeseries()
+            self._last_log_parsing = now
+        due = [supervised_run.resource_monitor for supervised_run in self.active
+               if supervised_run.resource_monitor is not None and supervised_run.resource_monitor.isDue()]
+        if len(due) > 0:
+            children = resource_usage.findChildProcesses()
+            for resource_monitor in due:
+                resource_monitor.sample(children=children)
+
+    def _reapExited(self):
+        for supervised_run in list(self.active):
+            if supervised_run.pipe_open:
+                continue
+
+            if supervised_run.poll() is None:
+                continue
+
+            if supervised_run.hasRepeatsLeft():
+                self._startRun(supervised_run)
+            else:
+                supervised_run.finish()
+                self.active.remove(supervised_run)
+                self.finished.append(supervised_run)
+
+    def step(self, timeout=None):
+        """
+        Handle output from and exits of active runs, waiting for at most
+        `timeout` seconds for something to happen.
+        """
+        # processes which have closed their output may not have exited yet, so
+        # keep checking on those
+        if any([not supervised_run.pipe_open for supervised_run in self.active]):
+            timeout = 0.05
+        elif timeout is None:
+            timeout = self.flush_interval
+        self._readOutput(int(timeout*1000.0))
+        self._reapExited()
+        self._startPending()
+
+    def run(self):
+        """
+        Run until all submitted tasks have finished, returns the finished
+        runs. If interrupted all active runs are killed.
+        """
+        try:
+            while len(self.active) > 0 or len(self.pending) > 0:
+                self.step()
+        except:
+            self.killAll()
+            raise
+        return self.finished
+
+    def killAll(self):
+        for supervised_run in list(self.active):
+            if supervised_run.pipe_open:
+                self._closePipe(supervised_run.process.stdout.fileno())
+            supervised_run.kill()
+            supervised_run.finish()
+            self.active.remove(supervised_run)
+            self.finished.append(supervised_run)
@@ -0,0 +1,205 @@
+"""
+Packing finished runs into one compressed archive per run.
+
+A run directory holds the runscript, runfiles, log and all output of a task
+as individual files. Once a run has finished `archiveRun` packs the whole
+directory into a zip file next to it (`task_20140301_120000/` becomes
+`task_20140301_120000.zip`) and removes the directory. Zip files have an
+index of their members, so single files can be read without unpacking the
+rest of the archive.
+
+Files of archived runs can still be read through their original paths with
+`run_handling.openRunFile`, which `loadTask`, `getLog`, `getRunDuration` and
+the run status functions use, and archived runs are found by
+`findTaskFiles` like any other::
+
+    archiveRuns('/data/runs')
+    task = loadTask('/data/runs/task_20140301_120000/taskfile.tsk')
+    task.getLog()
+"""
+
+import os
+import re
+import shutil
+import zipfile
+
+import run_handling
+
+ARCHIVE_SUFFIX = '.zip'
+
+# archives of run directories allocated by `getFreeOutputDirectory`, the only
+# ones searched for taskfiles
+_run_archive_re = re.compile(r'^task_\d{8}_\d{6}(_\d+)?%s$' % re.escape(ARCHIVE_SUFFIX))
+
+# files which don't compress (much) are stored as they are
+UNCOMPRESSED_SUFFIXES = ('.zip', '.gz', '.bz2', '.xz', '.npz', '.h5', '.hdf5', '.nc', '.png', '.jpg')
+
+# files which aren't worth keeping
+EXCLUDED_FILENAMES = (run_handling.LOCKFILE_FILENAME, 'taskfile.tsk' + run_handling.TASK_CACHE_SUFFIX)
+
+def getArchiveFilename(output_directory):
+    return os.path.normpath(output_directory) + ARCHIVE_SUFFIX
+
+def isArchived(output_directory):
+    return os.path.isfile(getArchiveFilename(output_directory))
+
+def findArchive(filename):
+    """
+    Find the archive holding `filename` (a path in an archived run
+    directory), returns the archive's filename and the name of the member or
+    (None, None) if `filename` isn't in an archive.
+    """
+    path = os.path.normpath(filename)
+    member = []
+    while True:
+        path, name = os.path.split(path)
+        if name == "":
+            return None, None
+        member.insert(0, name)
+        if os.path.isfile(path + ARCHIVE_SUFFIX):
+            return path + ARCHIVE_SUFFIX, "/".join(member)
+
+def openArchivedFile(filename):
+    """
+    Open the member of a run archive corresponding to `filename`. Returns a
+    (read-only, not seekable) file object, or None if there is no such member.
+    """
+    archive_filename, member = findArchive(filename)
+    if archive_filename is None:
+        return None
+    archive = zipfile.ZipFile(archive_filename, "r")
+    try:
+        # the member gets a file handle of its own and stays readable
+        return archive.open(member)
+    except KeyError:
+        return None
+    finally:
+        archive.close()
+
+def listArchivedFiles(output_directory):
+    archive = zipfile.ZipFile(getArchiveFilename(output_directory), "r")
+    try:
+        return archive.namelist()
+    finally:
+        archive.close()
+
+def archiveRun(output_directory, remove=True, force=False):
+    """
+    Pack the run in `output_directory` into an archive next to it, removing
+    the directory once the archive has been written and checked (unless
+    `remove` is False). Only finished runs are archived unless `force` is
+    set. Returns the archive's filename.
+    """
+    if not force:
+        state = run_handling.classifyRunDirectory(output_directory)
+        if state != 'finished':
+            raise ValueError("The run in %s is %s, only finished runs can be archived" % (output_directory, state.replace("_", " ")))
+
+    archive_filename = getArchiveFilename(output_directory)
+    tmp_filename = "%s.%d.tmp" % (archive_filename, os.getpid())
+    archive = zipfile.ZipFile(tmp_filename, "w", zipfile.ZIP_DEFLATED, allowZip64=True)
+    try:
+        for root, dirnames, filenames in os.walk(output_directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename in EXCLUDED_FILENAMES:
+                    continue
+                full_filename = os.path.join(root, filename)
+                member = os.path.relpath(full_filename, output_directory)
+                if os.path.splitext(filename)[1].lower() in UNCOMPRESSED_SUFFIXES:
+                    archive.write(full_filename, member, zipfile.ZIP_STORED)
+                else:
+                    archive.write(full_filename, member)
+        archive.close()
+
+        archive = zipfile.ZipFile(tmp_filename, "r")
+        bad_member = archive.testzip()
+        archive.close()
+        if bad_member is not None:
+            raise IOError("%s was corrupted when archiving %s" % (bad_member, output_directory))
+        os.rename(tmp_filename, archive_filename)
+    except:
+        archive.close()
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+    if remove:
+        shutil.rmtree(output_directory)
+    return archive_filename
+
+def unarchiveRun(output_directory, remove=True):
+    """
+    Unpack an archived run back into `output_directory`.
+    """
+    archive_filename = getArchiveFilename(output_directory)
+    archive = zipfile.ZipFile(archive_filename, "r")
+    try:
+        archive.extractall(output_directory)
+    finally:
+        archive.close()
+    if remove:
+        os.remove(archive_filename)
+
+def archiveRuns(output_directory_base, remove=True):
+    """
+    Archive every finished run directly in `output_directory_base`, runs
+    which are still going (or stopped without finishing) are left as they
+    are. Returns the filenames of the archives written.
+    """
+    archives = []
+    for name in sorted(os.listdir(output_directory_base)):
+        output_directory = os.path.join(output_directory_base, name)
+        if not os.path.isfile(os.path.join(output_directory, 'taskfile.tsk')):
+            continue
+        if run_handling.classifyRunDirectory(output_directory) != 'finished':
+            continue
+        archives.append(archiveRun(output_directory, remove=remove, force=True))
+    return archives
+
+def getModificationTime(filename):
+    """
+    mtime of `filename`, or of the archive holding it if its run has been
+    archived.
+    """
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        archive_filename, member = findArchive(filename)
+        if archive_filename is None:
+            raise
+        return os.stat(archive_filename).st_mtime
+
+def findArchivedTaskfiles(directory, filenames, known_archives={}):
+    """
+    Taskfiles in the run archives among `filenames` (in `directory`), as the
+    paths they had before the runs were archived. Only archives named like
+    run directories (`task_20140301_120000.zip`) are looked at, and archives
+    in `known_archives` (a dict of archive filename to mtime) which haven't
+    been modified since are assumed to still hold their taskfile rather than
+    being opened again.
+    """
+    taskfiles = []
+    for filename in filenames:
+        if _run_archive_re.match(filename) is None:
+            continue
+        archive_filename = os.path.normpath(os.path.join(directory, filename))
+        if archive_filename in known_archives:
+            try:
+                if os.stat(archive_filename).st_mtime == known_archives[archive_filename]:
+                    taskfiles.append(os.path.join(archive_filename[:-len(ARCHIVE_SUFFIX)], 'taskfile.tsk'))
+                    continue
+            except OSError:
+                continue
+        try:
+            archive = zipfile.ZipFile(archive_filename, "r")
+        except (IOError, zipfile.BadZipfile):
+            continue
+        try:
+            archive.getinfo('taskfile.tsk')
+            taskfiles.append(os.path.join(archive_filename[:-len(ARCHIVE_SUFFIX)], 'taskfile.tsk'))
+        except KeyError:
+            pass
+        finally:
+            archive.close()
+    return taskfiles
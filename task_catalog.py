@@ -0,0 +1,301 @@
+"""
+Persistent index of the tasks stored below an output directory.
+
+Loading every `taskfile.tsk` with `findTaskFilesAndLoad` means parsing all of
+them each time, which gets slow once a results tree holds many thousands of
+tasks. A `TaskCatalog` keeps the task metadata, and the outcome of each run
+(from its status file, see `writeRunStatus`), in a SQLite file at the output
+base. Entries are keyed on the path (relative to the base) and mtime of each
+taskfile and status file, so that only new or modified files are read when
+the catalog is updated and queries never need to construct task objects.
+Records returned by queries load the full task with `load`. For example::
+
+    catalog = TaskCatalog('/data/runs')
+    catalog.update()
+    for record in catalog.query(owner='leif', description='bubble', complete=True, order_by='run_duration'):
+        print record.path, record.description, record.run_duration
+    task = record.load()
+"""
+
+import os
+import re
+import time
+import datetime
+import sqlite3
+
+import yaml
+
+import run_handling
+import task_archive
+
+CATALOG_FILENAME = 'task_catalog.sqlite'
+SCHEMA_VERSION = 2
+
+# taskfiles changed since the last update are parsed in a worker pool when
+# there are more than this many of them
+MIN_PARALLEL_PARSE = 50
+
+_task_directory_date_re = re.compile(r'task_(\d{8}_\d{6})')
+
+def _timestamp(t):
+    if t is None or isinstance(t, (int, float)):
+        return t
+    elif isinstance(t, datetime.datetime):
+        return time.mktime(t.timetuple()) + t.microsecond*1.0e-6
+    elif isinstance(t, datetime.date):
+        return time.mktime(t.timetuple())
+    else:
+        raise TypeError("Can't interpret %s as a date" % repr(t))
+
+def _creationTime(task_filename, mtime):
+    """
+    Tasks are stored in directories named after the time they were created
+    (see `getFreeOutputDirectory`), fall back to the taskfile's mtime when the
+    directory has been named differently.
+    """
+    match = _task_directory_date_re.search(os.path.basename(os.path.dirname(task_filename)))
+    if match is not None:
+        return time.mktime(time.strptime(match.group(1), "%Y%m%d_%H%M%S"))
+    else:
+        return mtime
+
+def _readMetadataOrNone(task_filename):
+    try:
+        return run_handling.readTaskMetadata(task_filename)
+    except (IOError, yaml.YAMLError):
+        return None
+
+def _findStatusFile(output_directory):
+    """
+    The file the outcome of the run in `output_directory` is read from, and
+    its mtime: the status file, or the log for runs from before status files
+    were written. Returns (None, None) if the run hasn't been started.
+    """
+    for filename in [run_handling.RUN_STATUS_FILENAME, "run.log"]:
+        full_filename = os.path.join(output_directory, filename)
+        try:
+            return full_filename, task_archive.getModificationTime(full_filename)
+        except OSError:
+            pass
+    return None, None
+
+def _readRunOutcome(status_filename):
+    """
+    Returns (complete, run_duration) of a run from its status file or log.
+    """
+    if status_filename is None:
+        return False, None
+    try:
+        if os.path.basename(status_filename) == "run.log":
+            run_duration = run_handling.findRunDurationInLog(status_filename)
+            return run_duration is not None, run_duration
+        run_status = run_handling.readRunStatus(os.path.dirname(status_filename))
+    except (IOError, yaml.YAMLError):
+        return False, None
+    if run_status is None:
+        return False, None
+    return bool(run_status.get('complete')), run_status.get('run_duration')
+
+class TaskRecord(object):
+    """
+    Lightweight description of a stored task as held in the catalog.
+    """
+    def __init__(self, output_directory_base, path, mtime, created, owner, description, task_name, task_type,
+                 status_mtime, complete, run_duration):
+        self.output_directory_base = output_directory_base
+        self.path = path
+        self.mtime = mtime
+        self.created = created
+        self.owner = owner
+        self.description = description
+        self.task_name = task_name
+        self.task_type = task_type
+        self.status_mtime = status_mtime
+        self.complete = bool(complete)
+        self.run_duration = run_duration
+        self._task = None
+
+    def load(self):
+        """
+        Load the full task object (only done once).
+        """
+        if self._task is None:
+            self._task = run_handling.loadTask(self.taskfile)
+        return self._task
+
+    @property
+    def taskfile(self):
+        return os.path.join(self.output_directory_base, self.path)
+
+    @property
+    def output_directory(self):
+        return os.path.dirname(self.taskfile)
+
+    def __str__(self):
+        return "%s (%s, %s): %s" % (self.path, self.owner, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(self.created)), self.description)
+
+    def __repr__(self):
+        return "<TaskRecord %s>" % self.path
+
+class TaskCatalog(object):
+    _columns = ('path', 'mtime', 'created', 'owner', 'description', 'task_name', 'task_type',
+                'status_mtime', 'complete', 'run_duration')
+    _order_columns = ('created', 'owner', 'description', 'task_name', 'task_type', 'run_duration', 'path')
+
+    def __init__(self, output_directory_base, filename=None):
+        self.output_directory_base = os.path.abspath(output_directory_base)
+        if filename is None:
+            filename = os.path.join(self.output_directory_base, CATALOG_FILENAME)
+        self.filename = filename
+
+        self.connection = sqlite3.connect(filename)
+        self._createSchema()
+
+    def _createSchema(self):
+        c = self.connection
+        (version,) = c.execute("PRAGMA user_version").fetchone()
+        if version != SCHEMA_VERSION:
+            # the catalog only caches what is in the taskfiles, so it is simply
+            # rebuilt when the layout has changed
+            c.execute("DROP TABLE IF EXISTS tasks")
+        c.execute("""CREATE TABLE IF NOT EXISTS tasks (
+                     path TEXT PRIMARY KEY,
+                     mtime REAL,
+                     created REAL,
+                     owner TEXT,
+                     description TEXT,
+                     task_name TEXT,
+                     task_type TEXT,
+                     status_mtime REAL,
+                     complete INTEGER,
+                     run_duration REAL)""")
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_owner ON tasks (owner)")
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_created ON tasks (created)")
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_task_name ON tasks (task_name)")
+        c.execute("CREATE INDEX IF NOT EXISTS tasks_complete_duration ON tasks (complete, run_duration)")
+        c.execute("PRAGMA user_version = %d" % SCHEMA_VERSION)
+        c.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def _findTaskfiles(self, known):
+        # archives already in the catalog needn't be opened again
+        known_archives = dict([(task_archive.getArchiveFilename(os.path.dirname(os.path.join(self.output_directory_base, path))), mtime)
+                               for (path, (mtime, status_mtime)) in known.items()])
+        taskfiles = {}
+        for root, dirnames, filenames in os.walk(self.output_directory_base):
+            task_filenames = task_archive.findArchivedTaskfiles(root, filenames, known_archives=known_archives)
+            if 'taskfile.tsk' in filenames:
+                task_filenames.append(os.path.join(root, 'taskfile.tsk'))
+            for task_filename in task_filenames:
+                path = os.path.relpath(task_filename, self.output_directory_base)
+                try:
+                    taskfiles[path] = task_archive.getModificationTime(task_filename)
+                except OSError:
+                    # removed while we were looking
+                    pass
+        return taskfiles
+
+    def update(self):
+        """
+        Bring the catalog up to date with the taskfiles on disk. Only taskfiles
+        which are new or have changed since the last update are parsed, and
+        only the status of runs whose status has changed is read again.
+        Returns the number of taskfiles (re-)parsed and the number removed.
+        """
+        c = self.connection
+        known = dict([(path, (mtime, status_mtime)) for (path, mtime, status_mtime)
+                      in c.execute("SELECT path, mtime, status_mtime FROM tasks").fetchall()])
+        taskfiles = self._findTaskfiles(known)
+
+        removed = [path for path in known if path not in taskfiles]
+        changed = sorted([path for (path, mtime) in taskfiles.items() if known.get(path, (None,))[0] != mtime])
+
+        status_updates = []
+        for path in taskfiles:
+            if path in known and known[path][0] == taskfiles[path]:
+                status_filename, status_mtime = _findStatusFile(os.path.dirname(os.path.join(self.output_directory_base, path)))
+                if status_mtime != known[path][1]:
+                    complete, run_duration = _readRunOutcome(status_filename)
+                    status_updates.append((status_mtime, complete, run_duration, path))
+
+        filenames = [os.path.join(self.output_directory_base, path) for path in changed]
+        if len(filenames) > MIN_PARALLEL_PARSE:
+            all_metadata = run_handling.get_workpool().map(_readMetadataOrNone, filenames)
+        else:
+            all_metadata = map(_readMetadataOrNone, filenames)
+
+        rows = []
+        for path, task_filename, metadata in zip(changed, filenames, all_metadata):
+            if metadata is None:
+                continue
+            mtime = taskfiles[path]
+            status_filename, status_mtime = _findStatusFile(os.path.dirname(task_filename))
+            complete, run_duration = _readRunOutcome(status_filename)
+            rows.append((path, mtime, _creationTime(task_filename, mtime),
+                         metadata['owner'], metadata['description'], metadata['task_name'], metadata['task_type'],
+                         status_mtime, complete, run_duration))
+
+        c.executemany("DELETE FROM tasks WHERE path = ?", [(path,) for path in removed])
+        c.executemany("INSERT OR REPLACE INTO tasks (%s) VALUES (%s)" % (", ".join(self._columns), ", ".join(["?"]*len(self._columns))), rows)
+        c.executemany("UPDATE tasks SET status_mtime = ?, complete = ?, run_duration = ? WHERE path = ?", status_updates)
+        c.commit()
+
+        return len(rows), len(removed)
+
+    def query(self, owner=None, description=None, task_name=None, task_type=None, created_after=None, created_before=None,
+              complete=None, min_duration=None, max_duration=None, order_by='created', descending=False, limit=None):
+        """
+        Find tasks in the catalog, `description` matches any task whose
+        description contains the given string. Dates may be given either as
+        `datetime` objects or as seconds since the epoch, run durations in
+        seconds. Tasks are returned as `TaskRecord`s, ordered by `order_by`
+        (one of `created`, `owner`, `description`, `task_name`, `task_type`,
+        `run_duration` and `path`).
+        """
+        if order_by not in self._order_columns:
+            raise ValueError("Can't order by %s, must be one of %s" % (order_by, ", ".join(self._order_columns)))
+
+        conditions = []
+        args = []
+        if owner is not None:
+            conditions.append("owner = ?")
+            args.append(owner)
+        if description is not None:
+            conditions.append("instr(description, ?) > 0")
+            args.append(description)
+        if task_name is not None:
+            conditions.append("task_name = ?")
+            args.append(task_name)
+        if task_type is not None:
+            conditions.append("task_type = ?")
+            args.append(task_type)
+        if created_after is not None:
+            conditions.append("created >= ?")
+            args.append(_timestamp(created_after))
+        if created_before is not None:
+            conditions.append("created <= ?")
+            args.append(_timestamp(created_before))
+        if complete is not None:
+            conditions.append("complete = ?")
+            args.append(int(bool(complete)))
+        if min_duration is not None:
+            conditions.append("run_duration >= ?")
+            args.append(min_duration)
+        if max_duration is not None:
+            conditions.append("run_duration <= ?")
+            args.append(max_duration)
+
+        sql = "SELECT %s FROM tasks" % ", ".join(self._columns)
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+        direction = " DESC" if descending else ""
+        sql += " ORDER BY %s%s, path%s" % (order_by, direction, direction)
+        if limit is not None:
+            sql += " LIMIT %d" % limit
+
+        return [TaskRecord(self.output_directory_base, *row) for row in self.connection.execute(sql, args)]
+
+    def __len__(self):
+        return self.connection.execute("SELECT COUNT(*) FROM tasks").fetchone()[0]
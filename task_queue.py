@@ -0,0 +1,333 @@
+"""
+Local, file-backed task queue, used by `BaseTask.enqueue` when `lsc_tasker`
+isn't available.
+
+A queue is a spool directory with the subdirectories
+
+    new/        taskfiles waiting to be run
+    claimed/    taskfiles being run by a worker
+    done/       taskfiles of runs which completed
+    failed/     taskfiles of runs which didn't complete
+
+Entries are moved between these with `rename`, which is atomic, so any
+number of workers (on one machine, or on several sharing the directory) can
+pull tasks from the same queue without two of them running the same task.
+A worker holds a lock on each entry it has claimed, entries claimed by
+workers which have since died are put back with `requeueAbandoned`.
+
+The filename of an entry encodes its priority, submission time and the number
+of cores the task needs, so that workers pick the next task by listing `new/`
+without parsing any taskfiles. Higher priorities are run first, tasks of the
+same priority in the order they were submitted. For example::
+
+    queue = TaskQueue('/data/queue')
+    for settings in settings_variants:
+        queue.put(Task(settings=settings, ...), priority=1)
+    QueueWorker(queue, output_directory_base='/data/runs').run()
+
+or from the command line, with as many workers as wanted:
+
+    python task_queue.py /data/queue /data/runs [max_cores]
+"""
+
+import os
+import errno
+import fcntl
+import time
+import socket
+import itertools
+
+import run_handling
+
+# queue used when no host or directory is given
+TASK_QUEUE_DIRECTORY = os.environ.get('PYCFD_TASK_QUEUE', os.path.expanduser(os.path.join('~', '.pycfd', 'task_queue')))
+
+QUEUE_STATES = ('new', 'claimed', 'done', 'failed')
+
+# priorities are stored offset so that entries sort by name
+MAX_PRIORITY = 49999
+
+_entry_counter = itertools.count()
+
+def getQueueDirectory(host=None):
+    """
+    The spool directory of the queue for `host`: the default queue for no host
+    (or localhost), `host` itself if it is a path and a queue named after the
+    host in the default location otherwise.
+    """
+    if host is None or host in ('localhost', socket.gethostname()):
+        return TASK_QUEUE_DIRECTORY
+    elif os.path.isabs(host):
+        return host
+    else:
+        return os.path.join(TASK_QUEUE_DIRECTORY, host)
+
+def _entryName(priority, cores):
+    if abs(priority) > MAX_PRIORITY:
+        raise ValueError("Priority must be between %d and %d" % (-MAX_PRIORITY, MAX_PRIORITY))
+    return "%05d_%017.6f_%d_%s_%d_%d.tsk" % (MAX_PRIORITY - priority, time.time(), cores,
+                                             socket.gethostname(), os.getpid(), _entry_counter.next())
+
+def parseEntryName(entry):
+    """
+    Returns (priority, submitted, cores) of the queue entry named `entry`.
+    """
+    fields = entry.split("_")
+    return (MAX_PRIORITY - int(fields[0]), float(fields[1]), int(fields[2]))
+
+class ClaimedEntry(object):
+    """
+    An entry claimed from the queue by a worker, locked until `finish` is
+    called.
+    """
+    def __init__(self, queue, entry, lockfile):
+        self.queue = queue
+        self.entry = entry
+        self.lockfile = lockfile
+
+    @property
+    def filename(self):
+        return self.queue._path('claimed', self.entry)
+
+    def finish(self, state):
+        os.rename(self.filename, self.queue._path(state, self.entry))
+        self.release()
+
+    def release(self):
+        fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+        self.lockfile.close()
+
+class TaskQueue(object):
+    def __init__(self, queue_directory=None):
+        if queue_directory is None:
+            queue_directory = getQueueDirectory()
+        self.queue_directory = queue_directory
+
+        for state in QUEUE_STATES:
+            try:
+                os.makedirs(os.path.join(queue_directory, state))
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _path(self, state, entry=''):
+        return os.path.join(self.queue_directory, state, entry)
+
+    def put(self, task, priority=0):
+        """
+        Add `task` to the queue, returns the name of its entry.
+        """
+        cores = run_handling.coresRequired(task)
+        entry = _entryName(priority, cores)
+
+        # written outside `new/` first so that workers never see half a
+        # taskfile, and self-contained as entries are moved around
+        tmp_filename = self._path('', ".%s.tmp" % entry)
+        run_handling.writeTask(task, tmp_filename, array_sidecars=False)
+        os.rename(tmp_filename, self._path('new', entry))
+        return entry
+
+    def list(self, state='new'):
+        """
+        Names of the entries in `state`, in the order they will be run.
+        """
+        return sorted([entry for entry in os.listdir(self._path(state)) if entry.endswith(".tsk")])
+
+    def __len__(self):
+        return len(self.list('new'))
+
+    def claim(self, max_cores=None):
+        """
+        Claim the next entry needing at most `max_cores` cores. Returns a
+        `ClaimedEntry`, or None if there is nothing to run. Entries which
+        don't fit are only skipped in favour of entries of the same priority,
+        so that lower priority tasks can't keep a large one waiting.
+        """
+        waiting_priority = None
+        for entry in self.list('new'):
+            priority, submitted, cores = parseEntryName(entry)
+            if waiting_priority is not None and priority < waiting_priority:
+                break
+            if max_cores is not None and cores > max_cores:
+                waiting_priority = priority
+                continue
+
+            try:
+                os.rename(self._path('new', entry), self._path('claimed', entry))
+            except OSError as e:
+                if e.errno == errno.ENOENT:
+                    # another worker got there first
+                    continue
+                raise
+
+            claimed_entry = self._lockClaimed(entry)
+            if claimed_entry is not None:
+                return claimed_entry
+        return None
+
+    def _lockClaimed(self, entry):
+        filename = self._path('claimed', entry)
+        try:
+            lockfile = open(filename)
+        except IOError:
+            return None
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        # `requeueAbandoned` may have moved the entry back before we locked it
+        try:
+            still_claimed = os.fstat(lockfile.fileno()).st_ino == os.stat(filename).st_ino
+        except OSError:
+            still_claimed = False
+        if not still_claimed:
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+            return None
+        return ClaimedEntry(self, entry, lockfile)
+
+    def requeueAbandoned(self):
+        """
+        Put entries claimed by workers which are no longer running back into
+        the queue, returns their names.
+        """
+        requeued = []
+        for entry in self.list('claimed'):
+            filename = self._path('claimed', entry)
+            try:
+                lockfile = open(filename)
+            except IOError:
+                continue
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno in (errno.EAGAIN, errno.EACCES):
+                    # being run
+                    lockfile.close()
+                    continue
+                raise
+            try:
+                os.rename(filename, self._path('new', entry))
+                requeued.append(entry)
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    raise
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            lockfile.close()
+        return requeued
+
+def sendTask(task, host=None, priority=0):
+    """
+    Queue `task` for running on `host`, see `getQueueDirectory`. Stands in for
+    `lsc_tasker.utils.sendTask`.
+    """
+    queue = TaskQueue(getQueueDirectory(host))
+    entry = queue.put(task, priority=priority)
+    print "Queued %s as %s in %s" % (str(task.description), entry, queue.queue_directory)
+    return entry
+
+class QueueWorker(object):
+    """
+    Pulls tasks from a `TaskQueue` and runs them through `TaskRun`, keeping up
+    to `max_cores` cores busy (see `LocalSweepExecutor`). Tasks are run in the
+    output base they were created with, or `output_directory_base` if they
+    don't have one. Runs forever unless `exit_when_empty` is set, in which
+    case it returns once the queue is empty and all claimed tasks are done.
+    """
+    # how often entries of dead workers are put back in the queue (in seconds)
+    requeue_interval = 60.0
+
+    def __init__(self, queue, output_directory_base=None, max_cores=None, poll_interval=1.0, exit_when_empty=False):
+        self.queue = queue
+        self.output_directory_base = output_directory_base
+        self.exit_when_empty = exit_when_empty
+        self.executor = run_handling.LocalSweepExecutor(output_directory_base=output_directory_base, max_cores=max_cores,
+                                                        poll_interval=poll_interval)
+        self._claimed = {}
+        self._last_requeue = None
+
+    def _loadEntry(self, claimed_entry):
+        task = run_handling.loadTask(claimed_entry.filename, use_cache=False)
+        if task is not None:
+            # not where the task will be stored
+            task.taskfile = None
+            task.parent_directory = None
+        return task
+
+    def _submit(self, claimed_entry):
+        task = self._loadEntry(claimed_entry)
+        if task is None:
+            claimed_entry.finish('failed')
+            return
+        output_directory_base = getattr(task, 'output_directory_base', None) or self.output_directory_base
+        if output_directory_base is None:
+            print "Can't run %s, no output directory given" % claimed_entry.entry
+            claimed_entry.finish('failed')
+            return
+
+        # a reused earlier run of the same task is returned by the executor's
+        # next `step` like any other finished task
+        output_directory = self.executor.submit(task, output_directory_base=output_directory_base)
+        self._claimed[output_directory] = claimed_entry
+
+    def _stepExecutor(self):
+        for output_directory, exitcode in self.executor.step():
+            claimed_entry = self._claimed.pop(output_directory)
+            run_status = run_handling.readRunStatus(output_directory)
+            if run_status is not None and run_status.get('complete'):
+                claimed_entry.finish('done')
+            else:
+                claimed_entry.finish('failed')
+
+    def step(self):
+        """
+        Start as many queued tasks as there are free cores for and record the
+        outcome of those which have finished. Returns True while tasks are
+        running or waiting in the queue.
+        """
+        if self._last_requeue is None or time.time() - self._last_requeue > self.requeue_interval:
+            self.queue.requeueAbandoned()
+            self._last_requeue = time.time()
+
+        self._stepExecutor()
+        cores_free = self.executor.coresFree()
+        while cores_free > 0:
+            if cores_free == self.executor.max_cores:
+                # an idle worker runs whatever is next, see `run_handling.coresRequired`
+                claimed_entry = self.queue.claim()
+            else:
+                claimed_entry = self.queue.claim(max_cores=cores_free)
+            if claimed_entry is None:
+                break
+            self._submit(claimed_entry)
+            self._stepExecutor()
+            cores_free = self.executor.coresFree()
+
+        return len(self._claimed) > 0 or len(self.queue) > 0
+
+    def run(self):
+        try:
+            while self.step() or not self.exit_when_empty:
+                time.sleep(self.executor.poll_interval)
+        except KeyboardInterrupt:
+            # the runs were interrupted as well, wait for them to clean up
+            self._abandonClaimed(terminate=False)
+            raise
+        except:
+            self._abandonClaimed(terminate=True)
+            raise
+
+    def _abandonClaimed(self, terminate):
+        # let other workers pick up whatever we were running
+        self.executor.abandon(terminate=terminate)
+        for claimed_entry in self._claimed.values():
+            claimed_entry.release()
+        self._claimed = {}
+        self.queue.requeueAbandoned()
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) < 3:
+        print "Usage: %s queue_directory output_directory_base [max_cores]" % sys.argv[0]
+        sys.exit(1)
+    max_cores = None
+    if len(sys.argv) > 3:
+        max_cores = int(sys.argv[3])
+    QueueWorker(TaskQueue(sys.argv[1]), output_directory_base=sys.argv[2], max_cores=max_cores).run()
@@ -0,0 +1,184 @@
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+import log_parsing
+import run_handling
+
+class ShellTask(run_handling.BaseTask):
+    def __init__(self, command, description):
+        self.command = command
+        self.num_processes = 1
+        super(ShellTask, self).__init__(generator="", description=description, owner="test")
+
+    def get_executable(self, outputdir):
+        return ['/bin/sh', '-c', self.command]
+
+def test_sweep_reports_task_exitcode():
+    output_directory_base = tempfile.mkdtemp()
+    try:
+        executor = run_handling.LocalSweepExecutor(output_directory_base=output_directory_base, max_cores=2, poll_interval=0.05)
+        completed = executor.submit(ShellTask('echo "Total time  : 0.1s"', "completes"))
+        failed = executor.submit(ShellTask('exit 3', "fails"))
+        killed = executor.submit(ShellTask('kill -9 $$', "is killed"))
+        exitcodes = dict(executor.run())
+
+        assert exitcodes[completed] == 0
+        assert exitcodes[failed] == 3
+        assert exitcodes[killed] == -9
+    finally:
+        shutil.rmtree(output_directory_base)
+
+def test_run_duration_from_malformed_log():
+    output_directory = tempfile.mkdtemp()
+    try:
+        log_filename = os.path.join(output_directory, "run.log")
+        fh = open(log_filename, "w")
+        fh.write("Total time  : 12.5s\nTotal time steps: 100\nTotal time: 3s\nTotal time:\n")
+        fh.close()
+        assert run_handling.findRunDurationInLog(log_filename) == 3.0
+
+        fh = open(log_filename, "w")
+        fh.write("Total time steps: 100\nTotal time\n")
+        fh.close()
+        assert run_handling.findRunDurationInLog(log_filename) is None
+        assert run_handling.classifyRunDirectory(output_directory) != 'finished'
+    finally:
+        shutil.rmtree(output_directory)
+
+def test_classify_run_with_leftover_lockfile():
+    output_directory = tempfile.mkdtemp()
+    try:
+        # a lockfile as written before heartbeats were introduced
+        fh = open(os.path.join(output_directory, run_handling.LOCKFILE_FILENAME), "w")
+        fh.write("2014-03-01 12:00:00.000000\n")
+        fh.close()
+        fh = open(os.path.join(output_directory, "run.log"), "w")
+        fh.write("step 1\n")
+        fh.close()
+        assert run_handling.classifyRunDirectory(output_directory) == 'stale'
+
+        fh = open(os.path.join(output_directory, "run.log"), "a")
+        fh.write("Total time  : 12.5s\n")
+        fh.close()
+        assert run_handling.classifyRunDirectory(output_directory) == 'finished'
+    finally:
+        shutil.rmtree(output_directory)
+
+def test_runfile_based_run_refuses_checkpoint_resume():
+    output_directory = tempfile.mkdtemp()
+    try:
+        task = ShellTask('true', "writes checkpoints")
+        task.checkpoint_patterns = ['*.chk']
+        fh = open(os.path.join(output_directory, "state.chk"), "w")
+        fh.close()
+        try:
+            run_handling.RunfileBasedTaskRun(task, output_directory_base=None, override_output_directory=output_directory,
+                                             resume=True)
+        except ValueError as e:
+            assert "state.chk" in str(e)
+        else:
+            assert False, "resuming a runscript from a checkpoint should fail"
+
+        os.remove(os.path.join(output_directory, "state.chk"))
+        task_run = run_handling.RunfileBasedTaskRun(task, output_directory_base=None, override_output_directory=output_directory,
+                                                    resume=True)
+        assert not task_run.resume
+    finally:
+        shutil.rmtree(output_directory)
+
+def test_sweep_step_forgets_finished_tasks():
+    output_directory_base = tempfile.mkdtemp()
+    try:
+        executor = run_handling.LocalSweepExecutor(output_directory_base=output_directory_base, max_cores=1, poll_interval=0.05)
+        first = executor.submit(ShellTask('echo "Total time  : 0.1s"', "first"))
+        second = executor.submit(ShellTask('exit 2', "second"))
+
+        finished = []
+        while executor.isBusy():
+            assert executor.coresFree() >= 0
+            finished += executor.step()
+            time.sleep(executor.poll_interval)
+        finished += executor.step()
+
+        assert finished == [(first, 0), (second, 2)]
+        assert executor.output_directories == []
+        assert executor.exitcodes == {}
+        assert executor.coresFree() == 1
+    finally:
+        shutil.rmtree(output_directory_base)
+
+def test_empty_log_timeseries_has_pattern_columns():
+    output_directory = tempfile.mkdtemp()
+    try:
+        pattern = log_parsing.LogPattern('steps', r"step (?P<n>\d+) t=(?P<t>[0-9.]+)")
+        timeseries = log_parsing.loadLogTimeseries(output_directory, 'steps', dtype=pattern.dtype)
+        assert len(timeseries) == 0
+        assert timeseries.dtype.names == ('n', 't')
+
+        fh = open(os.path.join(output_directory, "run.log"), "w")
+        fh.write("step 1 t=0.5\nstep 2 t=1.0\n")
+        fh.close()
+        log_parsing.updateLogTimeseries(output_directory, [pattern])
+        timeseries = log_parsing.loadLogTimeseries(output_directory, 'steps', dtype=pattern.dtype)
+        assert list(timeseries['t']) == [0.5, 1.0]
+    finally:
+        shutil.rmtree(output_directory)
+
+class EchoATask(run_handling.BaseTask):
+    def __init__(self):
+        super(EchoATask, self).__init__(generator="", description="echo", owner="test")
+
+    def get_executable(self, outputdir):
+        return ['/bin/sh', '-c', 'echo A; echo "Total time  : 0.1s"']
+
+class EchoBTask(EchoATask):
+    def get_executable(self, outputdir):
+        return ['/bin/sh', '-c', 'echo B; echo "Total time  : 0.1s"']
+
+def test_only_identical_tasks_are_reused():
+    output_directory_base = tempfile.mkdtemp()
+    try:
+        def run(task):
+            task_run = run_handling.TaskRun(task, output_directory_base, print_log=False)
+            with task_run:
+                task_run.communicate()
+            return task_run
+
+        first = run(EchoATask())
+        assert not first.reused
+        assert run(EchoATask()).reused
+        assert not run(EchoBTask()).reused
+
+        first = run(ShellTask('echo A; echo "Total time  : 0.1s"', "echo"))
+        assert not first.reused
+        assert run(ShellTask('echo A; echo "Total time  : 0.1s"', "another echo")).reused
+        assert not run(ShellTask('echo B; echo "Total time  : 0.1s"', "echo")).reused
+    finally:
+        shutil.rmtree(output_directory_base)
+
+def test_log_timeseries_drops_rows_of_unfinished_append():
+    output_directory = tempfile.mkdtemp()
+    try:
+        pattern = log_parsing.LogPattern('steps', r"step (?P<n>\d+)")
+        fh = open(os.path.join(output_directory, "run.log"), "w")
+        fh.write("step 1\nstep 2\n")
+        fh.close()
+        log_parsing.updateLogTimeseries(output_directory, [pattern])
+
+        # rows written by an update which died before rewriting the header
+        fh = open(os.path.join(output_directory, log_parsing.LOG_TIMESERIES_FILENAME_FORMAT % 'steps'), "ab")
+        fh.write(np.array([(99,)], dtype=pattern.dtype).tostring())
+        fh.close()
+
+        fh = open(os.path.join(output_directory, "run.log"), "a")
+        fh.write("step 3\n")
+        fh.close()
+        log_parsing.updateLogTimeseries(output_directory, [pattern])
+        timeseries = log_parsing.loadLogTimeseries(output_directory, 'steps', dtype=pattern.dtype)
+        assert list(timeseries['n']) == [1, 2, 3]
+    finally:
+        shutil.rmtree(output_directory)
@@ -7,54 +7,90 @@ objects.  By refusing to save these objects, we obviously loose
 that information, so make sure the things you drop are either
 stored somewhere else or not important.
 
+Numpy arrays are stored with an `!ndarray` tag giving their dtype
+and shape.  Small arrays (and all arrays dumped outside of
+`sidecarArrays`) hold their data inline
+
 >>> import yaml
->>> a = numpy.array([1,2,3])
+>>> a = numpy.array([1,2,3], dtype=numpy.int32)
 >>> print yaml.dump(a)
-null
-...
+!ndarray
+dtype: <i4
+shape: [3]
+data: [1, 2, 3]
 <BLANKLINE>
 
-The default behavior is to crash.
+while large arrays dumped inside `sidecarArrays` are written to
+`.npy` files next to the YAML file (named after their content)
+and only referenced from it.  When loaded, these are memory-mapped
+read-only rather than read into memory:
 
->>> yaml.Dumper.yaml_representers.pop(numpy.ndarray)  # doctest: +ELLIPSIS
-<function none_representer at 0x...>
->>> print yaml.dump(a)
-!!python/object/apply:numpy.core.multiarray._reconstruct
-args:
-- !!python/name:numpy.ndarray ''
-- !!python/tuple [0]
-- b
-state: !!python/tuple
-- 1
-- !!python/tuple [3]
-- null
-- false
-- "\\x01\\0\\0\\0\\x02\\0\\0\\0\\x03\\0\\0\\0"
+>>> import tempfile, shutil
+>>> directory = tempfile.mkdtemp()
+>>> with sidecarArrays(os.path.join(directory, 'taskfile.tsk')):
+...     print yaml.dump(numpy.zeros(1024))  # doctest: +ELLIPSIS
+!ndarray
+file: taskfile.tsk....npy
+dtype: <f8
+shape: [1024]
 <BLANKLINE>
-
-Hmm, at one point that crashed like this::
-
-    Traceback (most recent call last):
-      ...
-        if data in [None, ()]:
-    TypeError: data type not understood
-
-Must be because of the other representers I've loaded since.
-
-Restore the representer for future tests.
-
->>> yaml.add_representer(numpy.ndarray, none_representer)
+>>> shutil.rmtree(directory)
 """
 
 from __future__ import absolute_import
 import copy_reg
 import sys
 import types
+import os
+import time
+import glob
+import hashlib
+import threading
+import contextlib
+import StringIO
 
 import numpy
 import yaml
 import yaml.constructor
 import yaml.representer
+from yaml.constructor import ConstructorError
+from yaml.nodes import ScalarNode, SequenceNode, MappingNode
+
+# the LibYAML based loader and dumper are many times faster than the pure
+# Python ones, but PyYAML may have been built without them
+HAS_LIBYAML = getattr(yaml, '__with_libyaml__', False)
+if HAS_LIBYAML:
+    Loader = yaml.CLoader
+    Dumper = yaml.CDumper
+else:
+    Loader = yaml.Loader
+    Dumper = yaml.Dumper
+
+_loaders = set([yaml.Loader, Loader])
+_dumpers = set([yaml.Dumper, Dumper])
+
+def add_representer(data_type, representer):
+    """
+    Register `representer` with both the pure Python and LibYAML dumpers.
+    """
+    for dumper in _dumpers:
+        yaml.add_representer(data_type, representer, Dumper=dumper)
+
+def add_constructor(tag, constructor):
+    for loader in _loaders:
+        yaml.add_constructor(tag, constructor, Loader=loader)
+
+def dump(data, stream=None, **kwargs):
+    """
+    `yaml.dump` using LibYAML where available.
+    """
+    return yaml.dump(data, stream, Dumper=Dumper, **kwargs)
+
+def load(stream):
+    """
+    `yaml.load` using LibYAML where available.
+    """
+    return yaml.load(stream, Loader=Loader)
 
 if False: # YAML dump debugging code
     """To help isolate data types etc. that give YAML problems.
@@ -82,28 +118,29 @@ else:
                 return True
             if isinstance(data, (str, unicode, bool, int, float)):
                 return True
-        except TypeError, e:
+        except (TypeError, ValueError), e:
+            # arrays can't be compared with `in`
             pass
     yaml.representer.SafeRepresenter.ignore_aliases = staticmethod(
         ignore_aliases)
 
 def bool_representer(dumper, data):
     return dumper.represent_bool(data)
-yaml.add_representer(numpy.bool_, bool_representer)
+add_representer(numpy.bool_, bool_representer)
 
 def int_representer(dumper, data):
     return dumper.represent_int(data)
-yaml.add_representer(numpy.int32, int_representer)
-yaml.add_representer(numpy.dtype(numpy.int32), int_representer)
+add_representer(numpy.int32, int_representer)
+add_representer(numpy.dtype(numpy.int32), int_representer)
 
 def long_representer(dumper, data):
     return dumper.represent_long(data)
-yaml.add_representer(numpy.int64, int_representer)
+add_representer(numpy.int64, int_representer)
 
 def float_representer(dumper, data):
     return dumper.represent_float(data)
-yaml.add_representer(numpy.float32, float_representer)
-yaml.add_representer(numpy.float64, float_representer)
+add_representer(numpy.float32, float_representer)
+add_representer(numpy.float64, float_representer)
 
 # Monkey patch PyYAML bug 159.
 #   Yaml failed to restore loops in objects when __setstate__ is defined
@@ -162,4 +199,141 @@ def construct_object(self, node, deep=False):
     if deep:
         self.deep_construct = old_deep
     return data
+# shared by the pure Python and LibYAML loaders
 yaml.constructor.BaseConstructor.construct_object = construct_object
+
+
+NDARRAY_TAG = u'!ndarray'
+
+# arrays smaller than this (in bytes) are always stored inline
+SIDECAR_MIN_BYTES = 4096
+
+_sidecar_contexts = threading.local()
+
+def _arrayHash(data):
+    content_hash = hashlib.sha1("%s %s " % (data.dtype.str, data.shape))
+    content_hash.update(numpy.ascontiguousarray(data).data)
+    return content_hash.hexdigest()
+
+class SidecarContext(object):
+    """
+    Where the arrays of the YAML file `yaml_filename` are written to and
+    loaded from, see `sidecarArrays`.
+    """
+    def __init__(self, yaml_filename, open_file=open):
+        self.yaml_filename = yaml_filename
+        self.open_file = open_file
+        self.written = set()
+        self.loaded = 0
+
+    def _sidecarFilename(self, name):
+        return os.path.join(os.path.dirname(os.path.abspath(self.yaml_filename)), name)
+
+    def writeArray(self, data):
+        name = "%s.%s.npy" % (os.path.basename(self.yaml_filename), _arrayHash(data)[:16])
+        if name not in self.written and not os.path.exists(self._sidecarFilename(name)):
+            numpy.save(self._sidecarFilename(name), data)
+        self.written.add(name)
+        return name
+
+    def loadArray(self, name):
+        filename = self._sidecarFilename(name)
+        self.loaded += 1
+        if os.path.exists(filename):
+            return numpy.load(filename, mmap_mode='r')
+        # e.g. in an archive, can't be memory-mapped
+        fh = self.open_file(filename)
+        try:
+            return numpy.load(StringIO.StringIO(fh.read()))
+        finally:
+            fh.close()
+
+    def removeUnused(self):
+        """
+        Remove the sidecars of earlier versions of the YAML file.
+        """
+        pattern = "%s.%s.npy" % (self._sidecarFilename(os.path.basename(self.yaml_filename)), "[0-9a-f]"*16)
+        for filename in glob.glob(pattern):
+            if os.path.basename(filename) not in self.written:
+                os.remove(filename)
+
+class _HashingSidecarContext(SidecarContext):
+    def __init__(self):
+        SidecarContext.__init__(self, None)
+
+    def writeArray(self, data):
+        return _arrayHash(data)
+
+@contextlib.contextmanager
+def sidecarArrays(yaml_filename, open_file=open):
+    """
+    Store large arrays dumped (or loaded) in this context in sidecar files
+    of `yaml_filename`. With `yaml_filename` None arrays are replaced by a
+    hash of their content and nothing is written, which is much faster than
+    dumping them when the YAML is only needed for comparison.
+    """
+    if yaml_filename is None:
+        context = _HashingSidecarContext()
+    else:
+        context = SidecarContext(yaml_filename, open_file=open_file)
+    stack = _sidecar_contexts.__dict__.setdefault('stack', [])
+    stack.append(context)
+    try:
+        yield context
+    finally:
+        stack.pop()
+
+def _currentSidecarContext():
+    stack = getattr(_sidecar_contexts, 'stack', [])
+    if len(stack) > 0:
+        return stack[-1]
+    return None
+
+def ndarray_representer(dumper, data):
+    if data.dtype.hasobject or data.dtype.fields is not None:
+        # no simple way of writing these out
+        return dumper.represent_object(data)
+
+    context = _currentSidecarContext()
+    if context is not None and data.nbytes >= SIDECAR_MIN_BYTES:
+        name = context.writeArray(data)
+        return dumper.represent_mapping(NDARRAY_TAG, [('file', name), ('dtype', data.dtype.str), ('shape', list(data.shape))])
+    return dumper.represent_mapping(NDARRAY_TAG, [('dtype', data.dtype.str), ('shape', list(data.shape)),
+                                                 ('data', data.ravel().tolist())])
+add_representer(numpy.ndarray, ndarray_representer)
+add_representer(numpy.memmap, ndarray_representer)
+
+def ndarray_constructor(loader, node):
+    fields = loader.construct_mapping(node, deep=True)
+    if 'file' in fields:
+        context = _currentSidecarContext()
+        if context is None:
+            raise ConstructorError(None, None,
+                 "array stored in %s, but no sidecar context given" % fields['file'], node.start_mark)
+        return context.loadArray(fields['file'])
+    return numpy.array(fields['data'], dtype=str(fields['dtype'])).reshape(fields['shape'])
+add_constructor(NDARRAY_TAG, ndarray_constructor)
+
+def benchmark(data, repeats=5):
+    """
+    Time dumping and loading `data` (e.g. a large task) with the pure Python
+    and, if available, the LibYAML dumper and loader. Returns the average
+    (dump, load) times in seconds for each.
+    """
+    pairs = [('python', yaml.Dumper, yaml.Loader)]
+    if HAS_LIBYAML:
+        pairs.append(('libyaml', yaml.CDumper, yaml.CLoader))
+
+    timings = {}
+    for name, dumper, loader in pairs:
+        t0 = time.time()
+        for n in range(repeats):
+            content = yaml.dump(data, Dumper=dumper)
+        t_dump = (time.time() - t0)/repeats
+        t0 = time.time()
+        for n in range(repeats):
+            yaml.load(content, Loader=loader)
+        t_load = (time.time() - t0)/repeats
+        timings[name] = (t_dump, t_load)
+        print "%s: dump %.3fs, load %.3fs (%d bytes)" % (name, t_dump, t_load, len(content))
+    return timings